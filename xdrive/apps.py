@@ -2,25 +2,33 @@
 """     
 install and manage applications on Amazon Linux AMI using yum install 
     
-NOTE: This is a set of functions not a class
+NOTE: This is a set of functions not a class. Functions that run commands
+take host=None. See host.py
 """
 import logging as log
 import os
 import io
 import json
+import shlex
 import requests
-from time import sleep
+from time import sleep, time
 import pyperclip
+import pandas as pd
 
 import fabric.api as fab
 from fabric.state import connections
 from fabric.contrib.files import exists
+from .host import connect, remote
+
+NVIDIA_VOLUMES = "/var/lib/nvidia-docker/volumes"
+XDRIVE_NVIDIA_VOLUMES = f"/v1{NVIDIA_VOLUMES}"
 
 ################ xdrive functions ######################
 
 def setdebug():
     fab.output['everything'] = log.getLogger().getEffectiveLevel() <= log.DEBUG    
 
+@remote
 def install_docker():
     setdebug()
     
@@ -34,6 +42,7 @@ def install_docker():
     log.info("docker installed. if need to pull images then use ssh "\
              "as this shows progress whereas fabric does not")
 
+@remote
 def install_nvidia_docker():
     """ install nvidia_docker and plugin
     NOTE: uses instructions for "other" NOT "centos" as this fails
@@ -53,21 +62,70 @@ def install_nvidia_docker():
             "/usr/bin -xvf /tmp/nvidia-docker*.tar.xz "\
             "&& rm /tmp/nvidia-docker*.tar.xz")
     
-    # if drivers exist then -d=/v1/driver/folder.
+    start_nvidia_docker_plugin()
+
+@remote
+def nvidia_driver_version():
+    """ returns nvidia driver version or None if no gpu """
+    with fab.quiet():
+        r = fab.run("nvidia-smi --query-gpu=driver_version "\
+                    "--format=csv,noheader")
+    if r.failed:
+        return None
+    return r.splitlines()[0].strip()
+
+@remote
+def start_nvidia_docker_plugin():
+    """ start nvidia-docker-plugin using driver volume on /v1 if available
+
+    driver volumes are stored in versioned folders on /v1 so several driver
+    versions can coexist. the one matching the current driver is used.
+    """
+    setdebug()
+    version = nvidia_driver_version()
+    if not version:
+        log.warning("nvidia drivers not found")
+        return
+    with fab.quiet():
+        if fab.run("pidof nvidia-docker-plugin").succeeded:
+            log.info("nvidia-docker-plugin is already running")
+            return
+
     # better to keep on /v1 as copying to boot drive takes several seconds
-    volumepath = "/v1/var/lib/nvidia-docker/volumes"
-    if exists(volumepath):
-        volumepath = f"-d {volumepath}"
-    else:
-        # if not then -d must be left blank until created by nvidia-docker run
-        volumepath = ""
+    # if not on /v1 then -d must be left blank until created by
+    # nvidia-docker run. sync_nvidia_volumes then copies to /v1.
+    volumepath = ""
+    if exists(f"{XDRIVE_NVIDIA_VOLUMES}/nvidia_driver/{version}"):
+        volumepath = f"-d {XDRIVE_NVIDIA_VOLUMES}"
+        log.info(f"using nvidia driver {version} volume on /v1")
 
     # NOTE fab.run used as fab.sudo command does not accept -b option
     # -b for background. nohup for run forever.
     # -s must be left blank for /run/docker/plugins NOT moved to /v1
     fab.run(f"sudo -b nohup nvidia-docker-plugin {volumepath}")
     log.info("nvidia-docker-plugin is running")
-    
+
+@remote
+def sync_nvidia_volumes():
+    """ copy changed files in current driver volume to versioned folder on /v1
+    """
+    setdebug()
+    version = nvidia_driver_version()
+    src = f"{NVIDIA_VOLUMES}/nvidia_driver/{version}/"
+    dst = f"{XDRIVE_NVIDIA_VOLUMES}/nvidia_driver/{version}/"
+    with fab.quiet():
+        # no gpu; volume not yet created; or plugin already using /v1
+        if not version or not exists(src):
+            return
+        if fab.run("mountpoint -q /v1").failed:
+            log.warning("/v1 not mounted so nvidia driver volume not saved")
+            return
+    fab.sudo(f"mkdir -p {dst}")
+    r = fab.sudo(f"rsync -a --delete --out-format='%n' {src} {dst}")
+    log.info(f"nvidia driver {version} volume synced to /v1. "
+             f"{len(r.splitlines())} files changed")
+
+@remote
 def set_docker_folder(folder="/var/lib"):
     """ set location of docker images and containers
     for xdrive volume = "/v1"
@@ -75,9 +133,7 @@ def set_docker_folder(folder="/var/lib"):
     setdebug()
 
     # create daemon.json settings
-    config = '{"graph":"%s/docker"}'%folder
-    fab.sudo("mkdir -p /etc/docker")
-    fab.put(io.StringIO(config), "/etc/docker/daemon.json", use_sudo=True)
+    set_daemon_config(graph=f"{folder}/docker")
     
     # create target folder
     fab.sudo(f"mkdir -p {folder}/docker")
@@ -86,14 +142,133 @@ def set_docker_folder(folder="/var/lib"):
     with fab.quiet():
         fab.sudo("service docker restart")
 
-def stop_docker():
+def get_daemon_config(host=None):
+    """ returns docker daemon.json as dict """
+    r = connect(host).run("cat /etc/docker/daemon.json", sudo=True)
+    if r.failed:
+        return dict()
+    try:
+        return json.loads(r)
+    except ValueError:
+        log.warning(f"unable to parse daemon.json. {r}")
+        return dict()
+
+@remote
+def set_daemon_config(**settings):
+    """ update docker daemon.json. takes effect on docker restart """
+    config = get_daemon_config()
+    config.update(settings)
+    fab.sudo("mkdir -p /etc/docker")
+    fab.put(io.StringIO(json.dumps(config)), "/etc/docker/daemon.json",
+            use_sudo=True)
+
+def stop_docker(host=None):
     """ terminate all containers and stop docker """
+    host = connect(host)
+    host.run("docker ps -aq | xargs -r docker stop", sudo=True)
+    host.run("service docker stop", sudo=True)
+    log.info("docker stopped")
+
+######## checkpoint/restore of containers ###############
+
+CHECKPOINTS = "/v1/checkpoints"
+CHECKPOINT_LABEL = "xdrive.checkpoint"
+
+@remote
+def enable_checkpoint():
+    """ install criu and enable docker experimental checkpoint.
+    restarts docker.
+
+    opt in by running containers with --label xdrive.checkpoint. these are
+    checkpointed to /v1 on disconnect and restored on next server.create.
+    """
+    setdebug()
+    with fab.quiet():
+        r = fab.sudo("yum install criu -y -q")
+    if r.failed:
+        log.warning("criu not available so containers cannot be checkpointed")
+        return
+    set_daemon_config(experimental=True)
+    with fab.quiet():
+        fab.sudo("service docker restart")
+    log.info("docker checkpoint enabled")
+
+def checkpoint(containers=None, host=None):
+    """ checkpoint running containers to /v1. this stops the containers.
+
+        containers = list of names. default is containers with xdrive label
+        returns dataframe of container, seconds, bytes
+        containers that cannot be checkpointed are left to stop normally
+
+        runs on the host's own connection as called on spot termination
+    """
+    host = connect(host)
+    # a manifest not yet restored would restore stale state on next create
+    host.run(f"rm -f {CHECKPOINTS}/manifest.json")
+    if containers is None:
+        r = host.run("docker ps --filter label=%s --format '{{.Names}}'"
+                     %CHECKPOINT_LABEL, sudo=True)
+        containers = r.splitlines() if r.succeeded else []
+    out = []
+    for container in containers:
+        folder = f"{CHECKPOINTS}/{container}"
+        start = time()
+        host.run(f"sudo rm -rf {folder} && mkdir -p {folder}")
+        r = host.run(f"docker checkpoint create --checkpoint-dir={folder} "
+                     f"{container} xdrive", sudo=True)
+        if r.failed:
+            log.warning(f"unable to checkpoint {container}. "
+                        f"it will be stopped without saving state. {r.stderr or r}")
+            continue
+        seconds = time() - start
+        size = int(host.run(f"du -sb {folder}", sudo=True).split()[0])
+        log.info(f"{container} checkpointed {size/2**20:.0f}MB "
+                 f"in {seconds:.1f} seconds")
+        out.append(dict(container=container, seconds=seconds, bytes=size))
+    if out:
+        host.run(f"echo {shlex.quote(json.dumps(out))} "
+                 f"> {CHECKPOINTS}/manifest.json")
+    return pd.DataFrame(out, columns=["container", "seconds", "bytes"])
+
+@remote
+def restore():
+    """ restore containers checkpointed to /v1
+
+        returns dataframe of container, seconds, restored
+        containers that cannot be restored are started without saved state
+    """
     setdebug()
+    f = io.BytesIO()
     with fab.quiet():
-        fab.run("docker ps -aq | xargs docker stop")
-        fab.sudo("service docker stop")
-        log.info("docker stopped")
+        r = fab.get(f"{CHECKPOINTS}/manifest.json", f)
+    if r.failed:
+        return None
+    enable_checkpoint()
+
+    out = []
+    for item in json.loads(f.getvalue()):
+        container = item["container"]
+        start = time()
+        with fab.quiet():
+            r = fab.run(f"docker start --checkpoint xdrive "
+                        f"--checkpoint-dir={CHECKPOINTS}/{container} "
+                        f"{container}")
+        restored = r.succeeded
+        if not restored:
+            log.warning(f"unable to restore {container} so starting "
+                        f"without saved state. {r}")
+            with fab.quiet():
+                fab.run(f"docker start {container}")
+        seconds = time() - start
+        log.info(f"{container} restored in {seconds:.1f} seconds")
+        out.append(dict(container=container, seconds=seconds,
+                        restored=restored))
+
+    # only restore once
+    fab.run(f"mv {CHECKPOINTS}/manifest.json {CHECKPOINTS}/restored.json")
+    return pd.DataFrame(out, columns=["container", "seconds", "restored"])
 
+@remote
 def commit(container):
     """ commits to image and deletes container """
     # get container metadata
@@ -107,16 +282,19 @@ def commit(container):
     fab.run(f"docker commit {container} {image}")
     fab.run(f"docker rm -f {container}")
         
+@remote
 def dangling():
     """ remove dangling docker images """
     setdebug()
     return fab.run("docker rmi $(docker images -f dangling=true -q)")
     
+@remote
 def get_names():
     """ gets list of container names """
     setdebug()
     return fab.run("docker inspect --format='{{.Name}}' $(docker ps -aq --no-trunc)")
 
+@remote
 def run(params):
     """ run container """
     setdebug()
@@ -126,25 +304,24 @@ def run(params):
     if r.succeeded:
         # nvidia-docker run and save drivers
         fab.run(f"nvidia-docker run {params}")
-        volumepath = "/v1/var/lib/nvidia-docker/volumes"
-        if exists(volumepath):
-            fab.sudo("cp -r --parents /var/lib/nvidia-docker/volumes /v1")
+        sync_nvidia_volumes()
     else:
         # cpu
         fab.run(f"docker run {params}")
 
-def wait_notebook():
+def wait_notebook(host=None):
     """ wait for notebook server """
+    host_string = connect(host).host_string
     log.info("waiting for jupyter notebook server")
     while True:
         try:
-            r=requests.get(f"http://{fab.env.host_string}:8888")
+            r=requests.get(f"http://{host_string}:8888")
             if r.status_code==200:
                 break
         except:
             pass
         sleep(5)
-    ip = f"{fab.env.host_string}:8888"
+    ip = f"{host_string}:8888"
     try:
         pyperclip.copy(ip)
     except:
@@ -154,12 +331,13 @@ def wait_notebook():
 
 ############ fastai specific #################################
 
-def start_fastai():
+def start_fastai(host=None):
     setdebug()
-    fab.run(f"docker start fastai")
-    wait_notebook()
+    with connect(host):
+        fab.run(f"docker start fastai")
+    wait_notebook(host)
     
-def run_fastai():
+def run_fastai(host=None):
     """ run fastai in container 
     version root user and nbs in container """
     log.warning("Working folder is now in container /fastai/deeplearning1/nbs")
@@ -168,17 +346,18 @@ def run_fastai():
              "-p 8888:8888 -d "\
              "--name fastai "\
              "simonm3/fastai"
-    run(params)
-    wait_notebook()
+    run(params, host=host)
+    wait_notebook(host)
 
 ########## fastai8 UNDER TEST ###################################
 
-def start_fastai8():
+def start_fastai8(host=None):
     setdebug()
-    fab.run(f"docker start fastai8")
-    wait_notebook()
+    with connect(host):
+        fab.run(f"docker start fastai8")
+    wait_notebook(host)
     
-def run_fastai8():
+def run_fastai8(host=None):
     """ run fastai in container 
     version root user and nbs in container """
     params = "-v /v1:/v1 "\
@@ -186,11 +365,12 @@ def run_fastai8():
              "-p 8888:8888 -d "\
              "--name fastai8 "\
              "simonm3/fastai8"
-    run(params)
-    wait_notebook()
+    run(params, host=host)
+    wait_notebook(host)
 
 ################## other applications ###############
     
+@remote
 def install_github(owner, projects):
     """ install github projects or project (if string passed) """
     setdebug()
@@ -203,6 +383,7 @@ def install_github(owner, projects):
     for project in projects:
         fab.run(getgit.format(owner=owner, project=project))
 
+@remote
 def install_python(project, configs=None):
     """ installs and runs python project in docker container
     """
@@ -229,6 +410,7 @@ def install_python(project, configs=None):
     fab.run(f"docker exec {project} pip install {project}")
     fab.run(f"docker exec -d {project} {project}")
             
+@remote
 def install_wordpress():
     setdebug()
     fab.run("mkdir wordpress || true")
@@ -236,12 +418,14 @@ def install_wordpress():
     with fab.cd("wordpress"):
         fab.run("docker-compose up -d")
 
+@remote
 def install_miniconda():
     setdebug()
     fab.run("wget https://repo.continuum.io/miniconda/"\
                 "Miniconda3-latest-Linux-x86_64.sh")
     fab.run("bash Miniconda3-latest-Linux-x86_64.sh")
     
+@remote
 def install_kaggle(user, password):
     """ note bug means must install in home folder not /v1
     will only download data to home and subfolders
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """
 manage aws resources
+    rate limit and retry ec2 calls
     manage tags
     list resources used
     
@@ -9,14 +10,144 @@ NOTE: This is a set of functions not a class
 import logging as log
 import pandas as pd
 import boto3
-import fabric.api as fab
-from time import sleep
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError, \
+                                ConnectionError, ParamValidationError
+import random
+from threading import Lock
+from time import sleep, time
 import pyperclip
+from .host import set_default
+
+### throttling ###########################################################
+
+# all ec2 calls from all clients and threads share one rate limit. botocore
+# retries are switched off so that retry_policy is the only retry policy.
+THROTTLE_CODES = {"RequestLimitExceeded", "Throttling",
+                  "ThrottlingException", "TooManyRequestsException"}
+CONFIG = Config(retries=dict(max_attempts=0))
+
+class TokenBucket():
+    """ thread safe token bucket with adaptive rate
+        rate halves when throttled and recovers gradually on success
+    """
+    def __init__(self, rate=10, burst=20, minrate=.5, recovery=.1):
+        """ rate = requests per second
+            burst = maximum tokens
+            minrate = lowest rate after throttling
+            recovery = rate increase per successful request
+        """
+        self.maxrate = self.rate = rate
+        self.burst = self.tokens = burst
+        self.minrate = minrate
+        self.recovery = recovery
+        self.last = time()
+        self.lock = Lock()
+
+    def acquire(self):
+        """ wait for a token """
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now-self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1-self.tokens) / self.rate
+            sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.minrate, self.rate/2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.maxrate, self.rate+self.recovery)
+
+limiter = TokenBucket()
+retry_policy = dict(attempts=8, base=.5, cap=30)
+_counters = dict(calls=0, throttled=0, retried=0, failed=0)
+_counterlock = Lock()
+
+def _count(key):
+    with _counterlock:
+        _counters[key] += 1
+
+def get_counters():
+    """ returns dict of calls, throttled, retried, failed and current rate """
+    with _counterlock:
+        counters = dict(_counters)
+    counters.update(rate=limiter.rate)
+    return counters
+
+def error_code(e):
+    """ returns aws error code from ClientError """
+    return e.response.get("Error", {}).get("Code", "")
+
+def is_throttle(e):
+    """ true if ClientError is throttling rather than a real error """
+    return isinstance(e, ClientError) and error_code(e) in THROTTLE_CODES
+
+def _before_send(**kwargs):
+    """ every http attempt waits for the shared limiter """
+    limiter.acquire()
+    _count("calls")
+
+def _needs_retry(response=None, attempts=None, caught_exception=None,
+                 operation=None, **kwargs):
+    """ returns seconds to wait before retry or None to not retry """
+    throttle = False
+    if response is not None:
+        code = response[1].get("Error", {}).get("Code")
+        throttle = code in THROTTLE_CODES
+        status = response[0].status_code
+        if not throttle and status < 500:
+            if status < 300:
+                limiter.succeeded()
+            return None
+    elif not isinstance(caught_exception, (HTTPClientError, ConnectionError)):
+        return None
+
+    if throttle:
+        limiter.throttled()
+        _count("throttled")
+    if attempts >= retry_policy["attempts"]:
+        _count("failed")
+        log.warning(f"{operation.name} failed after {attempts} attempts")
+        return None
+    _count("retried")
+    # exponential backoff with jitter
+    delay = min(retry_policy["cap"], retry_policy["base"] * 2**attempts)
+    return delay * random.uniform(.5, 1)
+
+def _limit(client):
+    """ apply shared limiter and retry policy to client """
+    events = client.meta.events
+    service = client.meta.service_model.service_name
+    events.register(f"before-send.{service}", _before_send)
+    events.register(f"needs-retry.{service}", _needs_retry)
+    return client
 
 ### connection #############################################################
 
-ec2 = boto3.resource('ec2')
-client = boto3.client('ec2')
+ec2 = boto3.resource('ec2', config=CONFIG)
+client = _limit(boto3.client('ec2', config=CONFIG))
+_limit(ec2.meta.client)
+_regional = dict()
+
+def regional(region=None):
+    """ returns ec2 resource and client for region. None is default region """
+    if region is None or region == client.meta.region_name:
+        return ec2, client
+    if region not in _regional:
+        regionec2 = boto3.resource('ec2', region_name=region, config=CONFIG)
+        _limit(regionec2.meta.client)
+        _regional[region] = (regionec2, _limit(boto3.client('ec2',
+                                    region_name=region, config=CONFIG)))
+    return _regional[region]
 
 ### manage tags ##############################################
     
@@ -60,7 +191,7 @@ def get(name=None, collections=None, unique=True):
         try:
             # snapshots collection includes the worlds snapshots!
             owned = list(collection.all().filter(OwnerIds=["self"]))
-        except:
+        except ParamValidationError:
             owned = list(collection.all())
         reslist.extend([res for res in owned if name is None 
                                or name == get_name(res)])
@@ -81,7 +212,7 @@ def associate_address(instance, ip=None):
     if ip == None:
         ip = get_ip()
     
-    fab.env.host_string = ip
+    set_default(ip)
     try:
         pyperclip.copy(ip)
     except:
@@ -96,19 +227,24 @@ def associate_address(instance, ip=None):
         log.info("waiting for ip address to be associated")
         sleep(2)
     name = get_name(instance)
-    log.info(f"{name} ready at {fab.env.host_string} (clipboard)")
+    log.info(f"{name} ready at {ip} (clipboard)")
 
 ### get all resources ####################################################
 
-def get_instances():
-    """ get dataframe of instances """
+def get_instances(regions=None):
+    """ get dataframe of instances
+        regions = list of regions. None for default region
+    """
     a=[]
-    for i in ec2.instances.all():
-        a.append([get_name(i), i.instance_id, i.image.image_id,
-                  i.instance_type, i.state["Name"],
-                  i.public_ip_address])
+    for region in regions or [None]:
+        regionec2 = regional(region)[0]
+        for i in regionec2.instances.all():
+            a.append([get_name(i), i.instance_id, i.image.image_id,
+                      i.instance_type, i.state["Name"],
+                      i.public_ip_address,
+                      regionec2.meta.client.meta.region_name])
     return pd.DataFrame(a, columns=["name", "instance_id","image","type",
-                                       "state","ip"])
+                                       "state","ip","region"])
     
 def get_ips():
     """ get list of elastic ips """
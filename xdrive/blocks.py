@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+changed blocks of drive snapshots using the EBS direct APIs
+    list blocks changed between two snapshots
+    churn per session i.e. between consecutive snapshots
+    predict size and duration of next snapshot
+    export changed blocks to a local block archive for off-AWS backup
+    rebuild a raw disk image from the archive
+
+use endpoint_url to run against a stubbed EBS direct endpoint.
+
+NOTE: This is a set of functions not a class
+"""
+import logging as log
+import os
+import json
+import base64
+import hashlib
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pandas as pd
+
+from . import aws
+
+# used when there is no snapshot history
+DEFAULT_RATE = 20 * 2**20
+SECONDS = "xdrive-seconds"
+CATALOG = "catalog.json"
+
+def ebs_client(region=None, endpoint_url=None):
+    """ returns EBS direct client. not rate limited as limits are separate """
+    return boto3.client("ebs", region_name=region or aws.client.meta.region_name,
+                        endpoint_url=endpoint_url)
+
+def changed_blocks(second, first=None, ebs=None):
+    """ yields dict(index, token, size, volume) of blocks changed from first
+        to second. size is bytes. volume is volume size in GiB
+        first=None yields all blocks of second
+        token is None for blocks that are no longer in second
+    """
+    ebs = ebs or ebs_client()
+    kwargs = dict(MaxResults=10000)
+    while True:
+        if first:
+            r = ebs.list_changed_blocks(FirstSnapshotId=first,
+                                        SecondSnapshotId=second, **kwargs)
+            blocks = [(b["BlockIndex"], b.get("SecondBlockToken"))
+                      for b in r["ChangedBlocks"]]
+        else:
+            r = ebs.list_snapshot_blocks(SnapshotId=second, **kwargs)
+            blocks = [(b["BlockIndex"], b["BlockToken"]) for b in r["Blocks"]]
+        for index, token in blocks:
+            yield dict(index=index, token=token, size=r["BlockSize"],
+                       volume=r["VolumeSize"])
+        if not r.get("NextToken"):
+            return
+        kwargs.update(NextToken=r["NextToken"])
+
+def churn(drive, sessions=5, ebs=None):
+    """ returns dataframe of changes between consecutive snapshots of drive
+
+        sessions = number of most recent sessions
+
+        blocks, bytes = changed since previous snapshot i.e. session churn
+        seconds = time taken to create snapshot if recorded
+        mbps = snapshot rate
+    """
+    ebs = ebs or ebs_client(drive.region)
+    snapshots = list(reversed(drive.snapshots(completed=True)[:sessions+1]))
+    a = []
+    for first, second in zip(snapshots[:-1], snapshots[1:]):
+        try:
+            blocks = list(changed_blocks(second.id, first.id, ebs))
+        except Exception as e:
+            log.warning(f"unable to compare {first.id} {second.id}. {e}")
+            continue
+        nbytes = sum(b["size"] for b in blocks)
+        seconds = aws.get_tag(second, SECONDS)
+        seconds = float(seconds) if seconds else None
+        a.append([second.id, second.start_time, len(blocks), nbytes, seconds,
+                  nbytes/seconds/2**20 if seconds else None])
+    return pd.DataFrame(a, columns=["snapshot", "start_time", "blocks",
+                                    "bytes", "seconds", "mbps"])
+
+def estimate(drive, written=None, sessions=5, ebs=None):
+    """ predict size and duration of next snapshot before disconnect
+
+        written = bytes written this session e.g. DiskMonitor.written()
+                  default uses median churn of previous sessions
+        returns dict(bytes, seconds, basis)
+    """
+    history = churn(drive, sessions, ebs)
+    if written is not None:
+        nbytes, basis = written, "written"
+    elif len(history):
+        nbytes, basis = history.bytes.median(), "history"
+    else:
+        return dict(bytes=None, seconds=None, basis="none")
+
+    rates = history.mbps.dropna()
+    rate = rates.median()*2**20 if len(rates) else DEFAULT_RATE
+    return dict(bytes=nbytes, seconds=nbytes/rate, basis=basis)
+
+def export(drive, folder, snapshot=None, workers=16, ebs=None):
+    """ export blocks changed since the last export to a local archive
+
+        folder = archive folder. one subfolder per exported snapshot
+        snapshot = snapshot id. default latest completed snapshot
+        first export of a drive is a full export
+        returns dict(snapshot, parent, blocks, bytes)
+    """
+    ebs = ebs or ebs_client(drive.region)
+    if snapshot is None:
+        snapshots = drive.snapshots(completed=True)
+        if not snapshots:
+            raise Exception("no completed snapshot of %s to export"%drive.name)
+        snapshot = snapshots[0].id
+    catalog = _load_catalog(folder)
+    if catalog and catalog[-1]["snapshot"] == snapshot:
+        log.info(f"{snapshot} already exported")
+        return catalog[-1]
+    parent = catalog[-1]["snapshot"] if catalog else None
+
+    blocks = list(changed_blocks(snapshot, parent, ebs))
+    target = os.path.join(folder, snapshot)
+    os.makedirs(target, exist_ok=True)
+    data = os.path.join(target, "blocks.bin")
+    present = [b for b in blocks if b["token"]]
+    size = blocks[0]["size"] if blocks else 0
+    volume = blocks[0]["volume"] if blocks \
+                        else drive.ec2.Snapshot(snapshot).volume_size
+
+    # each block has a fixed position in data file so can write in parallel
+    with open(data, "wb") as f:
+        f.truncate(len(present)*size)
+    lock = Lock()
+    done = [0]
+
+    def get(item):
+        position, block = item
+        r = ebs.get_snapshot_block(SnapshotId=snapshot,
+                                   BlockIndex=block["index"],
+                                   BlockToken=block["token"])
+        buf = r["BlockData"].read()
+        checksum = base64.b64encode(hashlib.sha256(buf).digest()).decode()
+        if checksum != r["Checksum"]:
+            raise Exception(f"checksum failed for block {block['index']}")
+        with open(data, "r+b") as f:
+            f.seek(position*size)
+            f.write(buf)
+        with lock:
+            done[0] += 1
+            if done[0] % 1000 == 0:
+                log.info(f"{done[0]}/{len(present)} blocks exported")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(get, enumerate(present)))
+
+    manifest = dict(snapshot=snapshot, parent=parent, block_size=size,
+                    volume_size=volume,
+                    blocks=[b["index"] for b in present],
+                    removed=[b["index"] for b in blocks if not b["token"]])
+    with open(os.path.join(target, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+    # catalog updated last so an interrupted export is repeated
+    entry = dict(snapshot=snapshot, parent=parent, blocks=len(present),
+                 bytes=len(present)*size)
+    catalog.append(entry)
+    with open(os.path.join(folder, CATALOG), "w") as f:
+        json.dump(catalog, f)
+    log.info(f"exported {len(present)} blocks of {snapshot} "
+             f"{'since ' + parent if parent else 'in full'}")
+    return entry
+
+def rebuild(folder, path, snapshot=None):
+    """ write raw disk image of snapshot from archive chain
+        snapshot = default latest exported
+    """
+    catalog = _load_catalog(folder)
+    ids = [entry["snapshot"] for entry in catalog]
+    end = ids.index(snapshot) if snapshot else len(ids)-1
+    with open(path, "wb") as image:
+        for snapshot in ids[:end+1]:
+            with open(os.path.join(folder, snapshot, "manifest.json")) as f:
+                manifest = json.load(f)
+            size = manifest["block_size"]
+            with open(os.path.join(folder, snapshot, "blocks.bin"), "rb") as f:
+                for index in manifest["blocks"]:
+                    image.seek(index*size)
+                    image.write(f.read(size))
+            for index in manifest["removed"]:
+                image.seek(index*size)
+                image.write(bytes(size))
+        # unwritten blocks at the end are not in the archive
+        image.truncate(manifest["volume_size"] * 2**30)
+    log.info(f"image of {ids[end]} written to {path}")
+
+def _load_catalog(folder):
+    try:
+        with open(os.path.join(folder, CATALOG)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
@@ -1,26 +1,53 @@
 # -*- coding: utf-8 -*-
-from . import aws, apps
+from . import aws, apps, blocks
+from .host import Host, connect, set_default
+from functools import wraps
 import logging as log
 import fabric.api as fab
-from time import sleep
+from time import sleep, time
 import json
-from io import BytesIO
+import os
+import re
+import shlex
+from datetime import datetime
+from threading import Thread
+import boto3
+from botocore.exceptions import ClientError
+import pandas as pd
+
+def remote(method):
+    """ decorator runs method connected to the drive's host """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with connect(self.host):
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class Drive():
     """ persistent storage for use with spot instances
     """
-    def __init__(self, name):
-        """ note minimal state (just name) to allow changes via AWS menus """
+    def __init__(self, name, region=None, host=None):
+        """ note minimal state (name, region) to allow changes via AWS menus
+            region = None for default region
+            host = Host or ip address. None uses fab.env. set by attach
+        """
         self.name = name
+        self.host = host
+        self.region = region or aws.client.meta.region_name
+        self.ec2, self.client = aws.regional(self.region)
     
-    def connect(self, instance):
-        """ connect drive to existing instance """
+    def connect(self, instance, fs="ext4"):
+        """ connect drive to existing instance
+            fs = filesystem profile if new volume. see FILESYSTEMS
+        """
         self.attach(instance)
-        self.formatdisk()
+        self.formatdisk(fs)
         self.mount()
         
-    def disconnect(self, save=True):
+    def disconnect(self, save=True, compact=False, written=None):
         """ disconnect cleanly and save to snapshot
+            compact = compact filesystem before snapshot. see trim
+            written = bytes written this session. see create_snapshot
         """
         apps.setdebug()
 
@@ -30,35 +57,90 @@ class Drive():
             self.delete_volume()
             return
         
-        # if docker on xdrive then stop
-        f = BytesIO()
-        with fab.quiet():
-            r = fab.get("/etc/docker/daemon.json", f, use_sudo=True)
-        if r.succeeded:
-            folder = json.loads(f.getvalue()).get("graph", "")
-            if folder.startswith("/v1"):
-                apps.stop_docker()
+        # own connection so spotcheck is not held up by other hosts
+        host = connect(self.host)
+        # if docker on xdrive then checkpoint opted in containers and stop
+        folder = apps.get_daemon_config(host=host).get("graph", "")
+        if folder.startswith("/v1"):
+            apps.checkpoint(host=host)
+            apps.stop_docker(host=host)
 
+        self.trim(compact)
         self.unmount()
         self.detach()
-        self.create_snapshot()
+        self.create_snapshot(written)
         self.delete_volume()
         
-        snapcount = len(aws.get(self.name, aws.ec2.snapshots, unique=False))
+        snapcount = len(aws.get(self.name, self.ec2.snapshots, unique=False))
         log.info(f"You now have {snapcount} {self.name} snapshots")
-        
+
+    def stage(self, bucket, prefix="", folder="/v1/data", workers=16,
+              bwlimit=None, endpoint_url=None, credentials=False):
+        """ download s3 bucket/prefix onto drive. runs on the instance.
+
+            objects already on drive with same etag/size are skipped
+            bwlimit = maximum MB/s
+            endpoint_url = alternative s3 endpoint e.g. local stand-in
+            credentials = pass local aws credentials. default uses instance role
+            returns dict of statistics
+        """
+        apps.setdebug()
+        script = "/tmp/xdrive_s3stage.py"
+        with connect(self.host) as host:
+            fab.put(os.path.join(os.path.dirname(__file__), "s3stage.py"),
+                    script)
+            with fab.quiet():
+                r = fab.run("python -c 'import boto3'")
+            if r.failed:
+                fab.sudo("pip install -q boto3")
+
+        args = [bucket, prefix, "--folder", folder, "--workers", workers]
+        if bwlimit:
+            args.extend(["--bwlimit", bwlimit])
+        if endpoint_url:
+            args.extend(["--endpoint-url", endpoint_url])
+        command = "python %s %s"%(script,
+                                  " ".join(shlex.quote(str(a)) for a in args))
+        # keys are sent on stdin as command lines are visible to all users
+        data = b""
+        if credentials:
+            creds = boto3.Session().get_credentials().get_frozen_credentials()
+            env = dict(AWS_ACCESS_KEY_ID=creds.access_key,
+                       AWS_SECRET_ACCESS_KEY=creds.secret_key)
+            if creds.token:
+                env.update(AWS_SESSION_TOKEN=creds.token)
+            data = (json.dumps(env) + "\n").encode()
+            command = f"{command} --stdin-credentials"
+
+        # staging can take hours so run without holding the host lock
+        status, r = host.execute(f"env AWS_DEFAULT_REGION={self.region} "
+                                 f"{command}", log_output=True, data=data)
+        try:
+            stats = json.loads(r.splitlines()[-1])
+        except (IndexError, ValueError):
+            raise Exception(f"staging failed\n{r}")
+        log.info("staged {objects} objects ({skipped} unchanged) {bytes} bytes "
+                 "in {seconds:.1f} seconds at {mbps:.1f} MB/s".format(**stats))
+        if stats["failed"]:
+            log.warning(f"failed to stage {stats['failed']}")
+        return stats
+
 ######## lower level functions ############################
         
-    def attach(self, instance, user="ec2-user"):
-        """ attach volume or snapshot """
+    def attach(self, instance, user="ec2-user", size=None):
+        """ attach volume or snapshot
+            size = size of empty volume created if no snapshot
+        """
         apps.setdebug()
 
         if isinstance(instance, str):
-            instance = aws.get(instance, collections=aws.ec2.instances)
+            instance = aws.get(instance, collections=self.ec2.instances)
 
-        fab.env.host_string = instance.public_ip_address
-        fab.env.user = user        
-        volume = aws.get(self.name, collections=aws.ec2.volumes)
+        if self.host is None:
+            # later calls that do not pass a host use this instance
+            set_default(instance.public_ip_address, user)
+        self.host = Host(instance.public_ip_address, user)
+        volume = aws.get(self.name, collections=self.ec2.volumes)
 
         if volume:
             # validate volume
@@ -69,14 +151,18 @@ class Drive():
         else:
             # create volume from snapshot
             snapshot = self.latest_snapshot()
-            if snapshot is None:
-                raise Exception("No volume or snapshot found "
-                                            "for %s"%self.name)
-            r = aws.client.create_volume(
-                    SnapshotId=snapshot.id,
+            spec = dict(
                     AvailabilityZone=instance.placement["AvailabilityZone"],
                     VolumeType="gp2")
-            volume = aws.ec2.Volume(r["VolumeId"])
+            if snapshot:
+                spec.update(SnapshotId=snapshot.id)
+            elif size:
+                spec.update(Size=size)
+            else:
+                raise Exception("No volume or snapshot found "
+                                            "for %s"%self.name)
+            r = self.client.create_volume(**spec)
+            volume = self.ec2.Volume(r["VolumeId"])
             aws.set_name(volume, self.name)
         
         # remove existing attachment
@@ -85,7 +171,7 @@ class Drive():
             
         # wait until available
         while True:
-            item = aws.client.describe_volumes(
+            item = self.client.describe_volumes(
                         VolumeIds=[volume.id])["Volumes"][0]
             if item["State"] == "available":
                 break
@@ -98,52 +184,93 @@ class Drive():
         
         # wait until usable.
         while True:
-            if fab.sudo("ls -l /dev/xvdf").succeeded:
-                break
+            with self.host:
+                if fab.sudo("ls -l /dev/xvdf").succeeded:
+                    break
             log.info("waiting until volume visible")
             sleep(1)
         log.info("volume attached")
             
-    def formatdisk(self):
-        """ format volume if no file system """
+    @remote
+    def formatdisk(self, fs="ext4"):
+        """ format volume if no file system
+            fs = filesystem profile. see FILESYSTEMS
+        """
         apps.setdebug()
         with fab.quiet():
             r = fab.sudo("blkid /dev/xvdf")
         if r.succeeded:
             log.warning("volume is already formatted")
             return
-        r = fab.sudo("mkfs -t ext4 /dev/xvdf")
+        r = fab.sudo(f"{FILESYSTEMS[fs]['mkfs']} /dev/xvdf")
         if r.failed:
             raise Exception("format failed as no volume attached")
-        log.info("volume formatted")
+        log.info(f"volume formatted as {fs}")
+
+    def fstype(self):
+        """ returns filesystem type of volume e.g. ext4 """
+        r = connect(self.host).run("blkid -o value -s TYPE /dev/xvdf",
+                                   sudo=True)
+        return r.strip() if r.succeeded else None
         
+    @remote
     def mount(self):
-        """ mount volume to v1 """
+        """ mount volume to v1 with options for its filesystem profile """
         apps.setdebug()
+        options = FILESYSTEMS.get(self.fstype(), dict(mount="defaults"))
         fab.sudo("mkdir -p /v1")
-        fab.sudo("mount /dev/xvdf /v1")
+        fab.sudo(f"mount -o {options['mount']} /dev/xvdf /v1")
         fab.sudo("chown -R %s:%s /v1"%(fab.env.user, fab.env.user))
         log.info("volume mounted")
     
+    def trim(self, compact=False):
+        """ discard free blocks so snapshot does not copy deleted data
+
+            compact = compact filesystem first. this rewrites blocks so only
+                      worthwhile occasionally after many deletions
+            returns dict(bytes trimmed)
+
+            NOTE: snapshot blocks avoided is not reported. fstrim reports
+            all free space discarded including blocks never written and
+            EBS gives no count of blocks a trim kept out of a snapshot.
+            blocks.churn reports blocks changed per snapshot after the
+            event.
+        """
+        host = connect(self.host)
+        fstype = self.fstype()
+        if compact and fstype in COMPACT:
+            log.info("compacting filesystem")
+            if host.run(COMPACT[fstype], sudo=True).failed:
+                log.warning("compact failed")
+        r = host.run("fstrim -v /v1", sudo=True)
+        if r.failed:
+            log.warning("fstrim failed. volume may not support discard")
+            return dict(bytes=0)
+
+        # e.g. "/v1: 1.2 GiB (1288490188 bytes) trimmed"
+        # or on util-linux 2.23 "/v1: 1288490188 bytes were trimmed"
+        found = re.search(r"(\d+) bytes", r)
+        trimmed = int(found.group(1)) if found else 0
+        log.info(f"{trimmed} bytes of free space trimmed")
+        return dict(bytes=trimmed)
+
     def unmount(self):
         """ unmount """
-        apps.setdebug()
-        
-        with fab.quiet():
-            r = fab.sudo("umount /v1")
+        host = connect(self.host)
+        r = host.run("umount /v1", sudo=True)
+        if r.succeeded:
+            log.info("volume dismounted")
+        else:
+            log.warning("dismount failed. trying to force.")
+            r = host.run("fuser -km /v1", sudo=True)
             if r.succeeded:
                 log.info("volume dismounted")
             else:
-                log.warning("dismount failed. trying to force.")
-                r = fab.sudo("fuser -km /v1")
-                if r.succeeded:
-                    log.info("volume dismounted")
-                else:
-                    log.warning("failed to force dismount")
+                log.warning("failed to force dismount")
            
     def detach(self):
         """ detach """
-        volume = aws.get(self.name, collections=aws.ec2.volumes)
+        volume = aws.get(self.name, collections=self.ec2.volumes)
         if not volume:
             raise Exception("volume %s does not exist"%self.name)
         if volume.attachments:
@@ -153,7 +280,7 @@ class Drive():
             
             # wait until available
             while True:
-                item = aws.client.describe_volumes(
+                item = self.client.describe_volumes(
                             VolumeIds=[volume.id])["Volumes"][0]
                 if item["State"] == "available":
                     break
@@ -161,36 +288,66 @@ class Drive():
                 sleep(15)
             log.info("volume available")
 
-    def create_snapshot(self):
-        volume = aws.get(self.name, collections=aws.ec2.volumes)
-        snap = aws.ec2.create_snapshot(VolumeId=volume.id)
+    def create_snapshot(self, written=None):
+        """ create snapshot and replicate to other regions in background
+            written = bytes written this session to estimate duration
+        """
+        regions = self.replication()
+        volume = aws.get(self.name, collections=self.ec2.volumes)
+        if aws.get_tag(volume, CLONE):
+            raise Exception("clones are ephemeral and cannot be snapshotted")
+        snap = self.ec2.create_snapshot(VolumeId=volume.id)
         aws.set_name(snap, self.name)
+        if regions:
+            aws.set_tag(snap, REPLICATE, ",".join(regions))
         
-        log.info("waiting for snapshot. this can take 15 minutes."\
+        try:
+            guess = blocks.estimate(self, written)
+        except Exception as e:
+            log.warning(f"unable to estimate snapshot size. {e}")
+            guess = dict(bytes=None)
+        if guess["bytes"] is None:
+            log.info("waiting for snapshot. this can take 15 minutes."\
                                               "Have a cup of tea.")
+        else:
+            log.info(f"waiting for snapshot. estimated {guess['bytes']/2**20:.0f}"
+                     f"MB changed taking {guess['seconds']/60:.0f} minutes")
+        start = time()
         while True:
             try:
-                item = aws.client.describe_snapshots(
+                item = self.client.describe_snapshots(
                             SnapshotIds=[snap.id])["Snapshots"][0]
-            except:
+            except ClientError as e:
                 # may delete snapshot via menus
-                break
+                if aws.error_code(e) != "InvalidSnapshot.NotFound":
+                    raise
+                log.warning(f"snapshot {snap.id} deleted before completion")
+                return
             if item["State"] == "completed":
                 break
+            if item["State"] == "error":
+                # volume is kept as there is no snapshot to restore from
+                raise Exception(f"snapshot {snap.id} failed")
             log.info("%s snapshot completed"%item["Progress"])
             sleep(60)
+        aws.set_tag(snap, blocks.SECONDS, str(int(time() - start)))
         log.info(f"snapshot completed")
+
+        if regions:
+            self.replicate(snap)
     
     def delete_volume(self):
-        volume = aws.get(self.name, collections=aws.ec2.volumes)
+        volume = aws.get(self.name, collections=self.ec2.volumes)
         volume.delete()
 
         while True:
             try:
-                item = aws.client.describe_volumes(
+                item = self.client.describe_volumes(
                             VolumeIds=[volume.id])["Volumes"][0]
-            except:
+            except ClientError as e:
                 # volume can be deleted before state set to deleted
+                if aws.error_code(e) != "InvalidVolume.NotFound":
+                    raise
                 break
             if item["State"] == "deleted":
                 break
@@ -200,23 +357,295 @@ class Drive():
         
     def latest_snapshot(self):
         """ returns most recent snapshot """  
-        volume = aws.get(self.name, collections=aws.ec2.volumes)
+        volume = aws.get(self.name, collections=self.ec2.volumes)
         if volume:
             raise Exception("%s volume already exists from a "\
                 "previous session. If you want to keep it then save it as a "\
                 "snapshot; name the snapshot %s; and delete volume. If you "\
                 "don't want to keep it then delete it"%(self.name, self.name))
-        snapshots = aws.get(self.name, collections=aws.ec2.snapshots, 
-                            unique=False)
+        snapshots = self.snapshots()
         if snapshots:
-            snapshots = sorted(snapshots, 
-                               key=lambda s:s.start_time, reverse=True)
             return snapshots[0]
+
+    def snapshots(self, region=None, completed=False):
+        """ returns snapshots in region, most recent first
+            copies from other regions are ordered by time of original
+        """
+        ec2 = aws.regional(region or self.region)[0]
+        snapshots = aws.get(self.name, collections=ec2.snapshots,
+                            unique=False) or []
+        if completed:
+            snapshots = [s for s in snapshots if s.state == "completed"]
+        return sorted(snapshots, key=lambda s:origin(s)[1], reverse=True)
         
     def resize(self, size):
         """ make volume larger """
         apps.setdebug()
         
-        volume = aws.get(self.name, collections=aws.ec2.volumes)
-        aws.client.modify_volume(VolumeId=volume.id, size=size)
-        fab.sudo("resize2fs /dev/xvdf")
\ No newline at end of file
+        volume = aws.get(self.name, collections=self.ec2.volumes)
+        self.client.modify_volume(VolumeId=volume.id, Size=size)
+
+        # filesystem can grow once modification is optimizing
+        while True:
+            item = self.client.describe_volumes_modifications(
+                    VolumeIds=[volume.id])["VolumesModifications"][0]
+            if item["ModificationState"] in ["optimizing", "completed"]:
+                break
+            log.info("waiting for volume modification")
+            sleep(5)
+        with connect(self.host):
+            fab.sudo(RESIZE.get(self.fstype(), RESIZE["ext4"]))
+        log.info(f"volume resized to {size}GiB")
+
+######## replication ######################################
+
+    def replication(self):
+        """ returns list of regions that snapshots are copied to
+            policy is held as tag on drive snapshots/volume
+        """
+        volumes = aws.get(self.name, self.ec2.volumes, unique=False) or []
+        for r in volumes + self.snapshots():
+            regions = aws.get_tag(r, REPLICATE)
+            if regions:
+                return [region for region in regions.split(",") if region]
+        return []
+
+    def set_replication(self, regions):
+        """ set regions that new snapshots are copied to. [] to stop """
+        res = aws.get(self.name, [self.ec2.volumes, self.ec2.snapshots],
+                      unique=False)
+        if not res:
+            raise Exception("%s has no volume or snapshot to hold "
+                            "replication policy"%self.name)
+        for r in res:
+            aws.set_tag(r, REPLICATE, ",".join(regions))
+
+    def replicate(self, snapshot=None, wait=False):
+        """ copy snapshot to replication regions
+            copy requests are sent immediately; progress polled in background
+            snapshot = None for latest completed snapshot
+        """
+        if snapshot is None:
+            snapshots = self.snapshots(completed=True)
+            if not snapshots:
+                raise Exception("no completed snapshot of %s to replicate"
+                                                            %self.name)
+            snapshot = snapshots[0]
+        source, sourcetime = origin(snapshot)
+        copies = []
+        for region in self.replication():
+            if region == self.region:
+                continue
+            ec2, client = aws.regional(region)
+
+            # already copied
+            if any(origin(s)[0] == source for s in self.snapshots(region)):
+                continue
+
+            # previous copies are retained so this copy is incremental
+            r = client.copy_snapshot(SourceRegion=self.region,
+                                     SourceSnapshotId=snapshot.id,
+                                     Description=f"xdrive {self.name} "
+                                                 f"copy of {source}")
+            copy = ec2.Snapshot(r["SnapshotId"])
+            aws.set_name(copy, self.name)
+            aws.set_tag(copy, SOURCE, source)
+            aws.set_tag(copy, SOURCETIME, sourcetime.isoformat())
+            aws.set_tag(copy, REPLICATE, ",".join(self.replication()))
+            log.info(f"copying snapshot {source} to {region} as {copy.id}")
+            copies.append(copy)
+
+        t = Thread(target=_wait_copies, args=[copies], daemon=True)
+        t.start()
+        if wait:
+            t.join()
+        return copies
+
+    def replication_status(self):
+        """ returns dataframe of replication of latest snapshot to each region
+            lag = hours between latest snapshot and latest completed copy
+        """
+        snapshots = self.snapshots()
+        if not snapshots:
+            return None
+        source, sourcetime = origin(snapshots[0])
+        a = []
+        for region in [self.region] + self.replication():
+            if region in [row[0] for row in a]:
+                continue
+            latest = [s for s in self.snapshots(region)
+                            if origin(s)[0] == source]
+            completed = self.snapshots(region, completed=True)
+            lag = None
+            if completed:
+                lag = (sourcetime - origin(completed[0])[1])\
+                                .total_seconds()/3600
+            if latest:
+                latest = latest[0]
+                a.append([region, latest.id, latest.state, latest.progress,
+                          lag])
+            else:
+                a.append([region, None, "missing", None, lag])
+        return pd.DataFrame(a, columns=["region", "snapshot", "state",
+                                        "progress", "lag_hours"])
+
+    def regions(self):
+        """ returns regions holding completed copy of latest snapshot
+            latest snapshot may have been taken in any replication region
+        """
+        candidates = []
+        for region in [self.region] + self.replication():
+            if region not in candidates:
+                candidates.append(region)
+        snapshots = dict()
+        for region in candidates:
+            snapshots[region] = self.snapshots(region)
+        latest = [origin(s[0]) for s in snapshots.values() if s]
+        if not latest:
+            return []
+        source = max(latest, key=lambda o: o[1])[0]
+        return [region for region in candidates
+                if any(origin(s)[0] == source and s.state == "completed"
+                       for s in snapshots[region])]
+
+######## read-only clones #################################
+
+    def clone(self, instances, mountpoint="/v1", device="/dev/xvdg"):
+        """ mount a read-only clone of latest snapshot on each instance
+            e.g. for data parallel workers reading the same data
+
+            instances = list of instances or instance names
+            clones are ephemeral: never snapshotted; delete with delete_clones
+            returns list of volumes
+        """
+        apps.setdebug()
+        instances = [aws.get(i, self.ec2.instances) if isinstance(i, str)
+                     else i for i in instances]
+        snapshots = self.snapshots(completed=True)
+        if not snapshots:
+            raise Exception("no completed snapshot of %s to clone"%self.name)
+        snapshot = snapshots[0]
+
+        # create all volumes then wait for all
+        volumes = []
+        for instance in instances:
+            r = self.client.create_volume(
+                    SnapshotId=snapshot.id,
+                    AvailabilityZone=instance.placement["AvailabilityZone"],
+                    VolumeType="gp2")
+            volume = self.ec2.Volume(r["VolumeId"])
+            aws.set_name(volume, f"{self.name}-clone")
+            aws.set_tag(volume, CLONE, self.name)
+            volumes.append(volume)
+        log.info(f"waiting for {len(volumes)} clone volumes available")
+        self.client.get_waiter("volume_available").wait(
+                            VolumeIds=[v.id for v in volumes])
+
+        # attach all then mount read-only on each
+        for instance, volume in zip(instances, volumes):
+            instance.attach_volume(VolumeId=volume.id, Device=device)
+        self.client.get_waiter("volume_in_use").wait(
+                            VolumeIds=[v.id for v in volumes])
+        for instance in instances:
+            with Host(instance.public_ip_address):
+                while True:
+                    with fab.quiet():
+                        if fab.sudo(f"ls -l {device}").succeeded:
+                            break
+                    log.info("waiting until volume visible")
+                    sleep(1)
+                with fab.quiet():
+                    fstype = fab.sudo(f"blkid -o value -s TYPE {device}")
+                # do not replay journal as device is read-only
+                options = dict(ext4="ro,noload", xfs="ro,norecovery")\
+                                .get(fstype, "ro")
+                fab.sudo(f"mkdir -p {mountpoint}")
+                fab.sudo(f"mount -o {options} {device} {mountpoint}")
+        log.info(f"{len(volumes)} read-only clones of {snapshot.id} mounted")
+        return volumes
+
+    def clones(self):
+        """ returns list of clone volumes """
+        return list(self.ec2.volumes.filter(
+                Filters=[dict(Name=f"tag:{CLONE}", Values=[self.name])]))
+
+    def delete_clones(self, mountpoint="/v1"):
+        """ unmount, detach and delete all clones """
+        apps.setdebug()
+        volumes = self.clones()
+        if not volumes:
+            return
+
+        # unmount
+        for volume in volumes:
+            if volume.attachments:
+                instance = self.ec2.Instance(
+                                volume.attachments[0]["InstanceId"])
+                if instance.public_ip_address:
+                    with Host(instance.public_ip_address):
+                        with fab.quiet():
+                            fab.sudo(f"umount {mountpoint}")
+
+        # detach and delete all
+        attached = [v for v in volumes if v.attachments]
+        for volume in attached:
+            volume.detach_from_instance(volume.attachments[0]["InstanceId"],
+                                        Force=True)
+        if attached:
+            self.client.get_waiter("volume_available").wait(
+                                VolumeIds=[v.id for v in attached])
+        for volume in volumes:
+            volume.delete()
+        log.info(f"{len(volumes)} clones deleted")
+
+# filesystem profiles. noatime avoids writing blocks when files are read.
+# discard at mkfs is skipped as new volumes are empty. btrfs compresses data
+# so fewer blocks change (zstd needs kernel 4.14+)
+FILESYSTEMS = dict(
+    ext4=dict(mkfs="mkfs -t ext4 -m 0 -E nodiscard", mount="noatime"),
+    xfs=dict(mkfs="mkfs -t xfs -f -K", mount="noatime"),
+    btrfs=dict(mkfs="mkfs -t btrfs -f -K", mount="noatime,compress=zstd"))
+
+COMPACT = dict(ext4="e4defrag /v1",
+               xfs="xfs_fsr /v1",
+               btrfs="btrfs balance start -dusage=50 /v1")
+
+RESIZE = dict(ext4="resize2fs /dev/xvdf",
+              xfs="xfs_growfs /v1",
+              btrfs="btrfs filesystem resize max /v1")
+
+REPLICATE = "xdrive-replicate"
+SOURCE = "xdrive-source"
+SOURCETIME = "xdrive-source-time"
+CLONE = "xdrive-clone"
+
+def origin(snapshot):
+    """ returns (id, start_time) of original snapshot that this was copied from
+    """
+    source = aws.get_tag(snapshot, SOURCE)
+    if source:
+        return source, datetime.fromisoformat(aws.get_tag(snapshot, SOURCETIME))
+    return snapshot.id, snapshot.start_time
+
+def _wait_copies(copies):
+    """ poll snapshot copies until complete """
+    copies = list(copies)
+    while copies:
+        for copy in list(copies):
+            try:
+                copy.load()
+            except Exception:
+                log.warning(f"snapshot copy {copy.id} no longer exists")
+                copies.remove(copy)
+                continue
+            region = copy.meta.client.meta.region_name
+            if copy.state == "completed":
+                log.info(f"snapshot copy to {region} completed")
+                copies.remove(copy)
+            elif copy.state == "error":
+                log.warning(f"snapshot copy to {region} failed")
+                copies.remove(copy)
+            else:
+                log.info(f"{copy.progress} snapshot copy to {region}")
+        if copies:
+            sleep(60)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+explicit connection to a host
+
+fabric keeps the current host in the process global fab.env. A Host carries
+its own host, user and key and applies them only inside a "with" block.
+A process wide lock serialises these blocks so a background thread such as
+spotcheck cannot run fabric commands against the host of the foreground
+thread.
+
+Host.run and Host.execute use the host's own ssh connection instead. They
+do not touch fab.env or take the lock so they run alongside fabric commands
+and commands on other hosts. Use them for anything long running or time
+critical such as saving the drive on spot termination.
+
+functions decorated with remote accept host=None. None uses fab.env so
+existing calls that set fab.env.host_string keep working.
+"""
+import logging as log
+import shlex
+import fabric.api as fab
+from fabric.network import normalize
+from functools import wraps
+from threading import Lock, RLock
+from time import sleep
+import paramiko
+
+_lock = RLock()
+BUFSIZE = 2**16
+
+# own ssh connections keyed by (user, host, port). independent of fabric.
+_clients = dict()
+_clients_lock = Lock()
+
+class Result(str):
+    """ output of Host.run with status like the result of fab.run """
+    def __new__(cls, out, status, stderr=""):
+        r = super().__new__(cls, out)
+        r.stderr = stderr
+        r.return_code = status
+        r.succeeded = status == 0
+        r.failed = not r.succeeded
+        return r
+
+class Host():
+    """ connection to one host """
+    def __init__(self, host_string=None, user=None, key_filename=None):
+        """ defaults are taken from fab.env """
+        if host_string is None:
+            # current host is only valid outside another thread's block
+            with _lock:
+                host_string = fab.env.host_string
+        self.host_string = host_string
+        self.user = user or fab.env.user
+        self.key_filename = key_filename or fab.env.key_filename
+        self._settings = []
+
+    def __repr__(self):
+        return f"Host({self.user}@{self.host_string})"
+
+    def __enter__(self):
+        _lock.acquire()
+        try:
+            settings = fab.settings(host_string=self.host_string,
+                                    user=self.user,
+                                    key_filename=self.key_filename)
+            settings.__enter__()
+        except:
+            _lock.release()
+            raise
+        self._settings.append(settings)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self._settings.pop().__exit__(*exc)
+        finally:
+            _lock.release()
+
+    @property
+    def session(self):
+        """ paramiko ssh client for host. connects if not connected.
+            shared by all threads using this host but not by fabric
+        """
+        key = self._key()
+        with _clients_lock:
+            client = _clients.get(key)
+        transport = client and client.get_transport()
+        if transport and transport.is_active():
+            return client
+
+        # connect outside the lock so other hosts are not held up
+        user, host, port = key
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, port=port, username=user,
+                       key_filename=self.key_filename, timeout=30)
+        with _clients_lock:
+            _clients[key] = client
+        return client
+
+    def run(self, command, sudo=False):
+        """ run short command on own connection without holding the lock
+
+            sudo = run as root
+            returns Result i.e. stdout with succeeded, failed, return_code
+            and stderr. stderr is kept apart so warnings do not break
+            parsing of output.
+        """
+        if sudo:
+            command = f"sudo -n bash -c {shlex.quote(command)}"
+        channel = self._open(command)
+        try:
+            out, err = [], []
+            while True:
+                if channel.recv_ready():
+                    out.append(channel.recv(BUFSIZE))
+                elif channel.recv_stderr_ready():
+                    err.append(channel.recv_stderr(BUFSIZE))
+                elif channel.exit_status_ready():
+                    break
+                else:
+                    sleep(.01)
+            status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        out = b"".join(out).decode(errors="replace")
+        err = b"".join(err).decode(errors="replace")
+        log.debug(f"[{self.host_string}] {command}\n{out}{err}")
+        return Result(out.rstrip("\n"), status, err.rstrip("\n"))
+
+    def execute(self, command, log_output=False, data=b""):
+        """ run long command on a new ssh channel without holding the lock
+
+            log_output = log each line of output as it arrives
+            data = sent to stdin e.g. secrets that must not be in command
+            returns exit status and combined stdout/stderr
+        """
+        channel = self._open(command, data, combine=True)
+        try:
+            out = []
+            for line in channel.makefile("r"):
+                out.append(line)
+                if log_output:
+                    log.info(line.rstrip())
+            return channel.recv_exit_status(), "".join(out)
+        finally:
+            channel.close()
+
+    def _open(self, command, data=b"", combine=False):
+        """ returns channel running command with data sent to stdin """
+        try:
+            channel = self.session.get_transport().open_session()
+        except (paramiko.SSHException, EOFError, OSError):
+            # idle connection dropped so reconnect once
+            with _clients_lock:
+                _clients.pop(self._key(), None)
+            channel = self.session.get_transport().open_session()
+        try:
+            channel.set_combine_stderr(combine)
+            channel.exec_command(command)
+            if data:
+                channel.sendall(data)
+            channel.shutdown_write()
+        except:
+            channel.close()
+            raise
+        return channel
+
+    def _key(self):
+        user, host, port = normalize(self.host_string)
+        return (self.user or user, host, int(port))
+
+def connect(host=None):
+    """ returns Host context
+
+        host = Host, ip address or None to use fab.env
+    """
+    if isinstance(host, Host):
+        return host
+    return Host(host)
+
+def set_default(host_string, user=None):
+    """ set fab.env host for calls that do not pass a host """
+    with _lock:
+        fab.env.host_string = host_string
+        if user:
+            fab.env.user = user
+
+def remote(func):
+    """ decorator adds host parameter and runs func connected to host """
+    @wraps(func)
+    def wrapper(*args, host=None, **kwargs):
+        with connect(host):
+            return func(*args, **kwargs)
+    return wrapper
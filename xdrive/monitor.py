@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+monitor disk throughput and gp2 burst credits for the mounted drive
+    samples /proc/diskstats on the instance at an interval
+    calculates iops, throughput, latency and utilisation
+    estimates gp2 burst balance from volume size and observed iops
+    warns when balance falls below a threshold
+"""
+import logging as log
+from datetime import datetime
+from math import ceil
+from threading import Thread, Event
+
+import pandas as pd
+
+from . import aws
+from .host import connect
+
+# gp2 burst model
+# https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ebs-volume-types.html
+BURST_IOPS = 3000
+BURST_CREDITS = 5.4e6
+MAX_IOPS = 16000
+# ios up to 256KiB count as one gp2 io
+IO_SIZE = 256 * 2**10
+SECTOR = 512
+
+class DiskMonitor():
+    """ samples disk stats for a drive in a background thread
+
+        e.g.
+        m = DiskMonitor(drive)
+        m.start()
+        m.data            # dataframe of samples
+        m.recommend()     # volume size that sustains observed iops
+        m.stop()
+    """
+    def __init__(self, drive, interval=10, device="xvdf", threshold=.2,
+                 balance=1., callback=None, autoresize=False):
+        """ drive = connected Drive
+            interval = seconds between samples
+            device = name in /proc/diskstats. nvme1n1 on nitro instances
+            threshold = fraction of burst balance that triggers warning
+            balance = estimated fraction of burst balance at start. new
+                      volumes start full
+            callback = called with (monitor, sample) on threshold alert
+            autoresize = resize volume to recommended size on alert
+        """
+        self.drive = drive
+        self.interval = interval
+        self.device = device
+        self.threshold = threshold
+        self.callback = callback
+        self.autoresize = autoresize
+
+        self.size = aws.get(drive.name, drive.ec2.volumes).size
+        self.baseline = min(max(100, 3*self.size), MAX_IOPS)
+        self.burst = self.baseline < BURST_IOPS
+        self.balance = balance * BURST_CREDITS
+
+        self.samples = []
+        self.alerted = False
+        self._last = None
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        """ start sampling in background """
+        self._stop.clear()
+        self._thread = Thread(target=self._run, daemon=True,
+                              name=f"monitor {self.drive.name}")
+        self._thread.start()
+
+    def stop(self):
+        """ stop sampling """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    @property
+    def data(self):
+        """ returns dataframe of samples indexed by time """
+        df = pd.DataFrame(self.samples)
+        if len(df):
+            df = df.set_index("time")
+        return df
+
+    def recommend(self, quantile=.95):
+        """ returns size in GiB whose baseline iops sustains observed iops """
+        df = self.data
+        if not len(df):
+            return self.size
+        iops = df.iops.quantile(quantile)
+        return max(self.size, min(ceil(iops/3), ceil(MAX_IOPS/3)))
+
+    def written(self):
+        """ returns bytes written since monitor started e.g. for
+            create_snapshot estimate. upper bound as rewrites count twice
+        """
+        return sum(sample["write_bytes"] for sample in self.samples)
+
+    def sample(self):
+        """ take one sample. returns dict or None if first sample """
+        # own connection so sampling does not wait for fabric commands
+        r = connect(self.drive.host).run(f"cat /proc/uptime; "
+                                         f"grep -w {self.device} /proc/diskstats")
+        if r.failed:
+            raise Exception(f"unable to read diskstats for {self.device}")
+        lines = r.splitlines()
+        uptime = float(lines[0].split()[0])
+        stats = [int(x) for x in lines[1].split()[3:14]]
+        last, self._last = self._last, (uptime, stats)
+        if last is None:
+            return None
+        return self._calc(uptime - last[0], last[1], stats)
+
+    ######## lower level functions ############################
+
+    def _calc(self, seconds, before, after):
+        """ returns sample from change in diskstats fields """
+        d = [b-a for a, b in zip(before, after)]
+        reads, readsectors, readms = d[0], d[2], d[3]
+        writes, writesectors, writems = d[4], d[6], d[7]
+        ios = reads + writes
+        nbytes = (readsectors + writesectors) * SECTOR
+
+        # large ios count as several gp2 ios
+        iops = max(ios, nbytes/IO_SIZE) / seconds
+        self._credit(iops, seconds)
+
+        sample = dict(time=datetime.now(),
+                      read_iops=reads/seconds,
+                      write_iops=writes/seconds,
+                      iops=iops,
+                      read_mbps=readsectors*SECTOR/seconds/2**20,
+                      write_mbps=writesectors*SECTOR/seconds/2**20,
+                      write_bytes=writesectors*SECTOR,
+                      latency_ms=(readms+writems)/ios if ios else 0.,
+                      util=min(d[9]/seconds/1000, 1.),
+                      queue=d[10]/seconds/1000,
+                      balance=self.balance/BURST_CREDITS if self.burst
+                                                         else 1.,
+                      empty_minutes=self._empty(iops))
+        self.samples.append(sample)
+        return sample
+
+    def _credit(self, iops, seconds):
+        """ update estimated burst balance """
+        if not self.burst:
+            return
+        self.balance += (self.baseline - iops) * seconds
+        self.balance = min(max(self.balance, 0), BURST_CREDITS)
+
+    def _empty(self, iops):
+        """ returns minutes until burst balance empty at current iops """
+        if not self.burst or iops <= self.baseline:
+            return None
+        return self.balance / (iops - self.baseline) / 60
+
+    def _alert(self, sample):
+        """ warn once each time balance falls below threshold """
+        if sample["balance"] >= self.threshold:
+            self.alerted = False
+            return
+        if self.alerted:
+            return
+        self.alerted = True
+        log.warning(f"{self.drive.name} burst balance estimated at "
+                    f"{sample['balance']:.0%}. throughput will fall to "
+                    f"{self.baseline} iops. {self.recommend()}GiB would "
+                    f"sustain current load")
+        if self.callback:
+            self.callback(self, sample)
+        if self.autoresize:
+            size = self.recommend()
+            if size > self.size:
+                self.drive.resize(size)
+                self.size = size
+                self.baseline = min(max(100, 3*size), MAX_IOPS)
+                self.burst = self.baseline < BURST_IOPS
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sample = self.sample()
+                if sample:
+                    self._alert(sample)
+            except Exception as e:
+                log.exception(e)
+            self._stop.wait(self.interval)
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+stage an s3 bucket prefix onto a local folder
+    objects are downloaded with parallel ranged GETs
+    objects whose etag and size match the manifest are skipped
+    optional bandwidth cap shared by all threads
+    throughput is reported while running
+
+NOTE: This is copied to the instance and run there by Drive.stage. It must
+be standalone and run on the python2 that ships with amazon linux as well
+as python3. Use endpoint_url to run against a local S3 stand-in.
+
+usage: python s3stage.py bucket [prefix] [options]
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import boto3
+
+MANIFEST = ".xdrive_s3manifest.json"
+
+def stage(bucket, prefix="", folder="/v1/data", workers=16,
+          partsize=8*2**20, bwlimit=None, endpoint_url=None, region=None,
+          manifest=None, every=10):
+    """ download bucket/prefix to folder
+
+        workers = number of parallel ranged GETs
+        partsize = bytes per ranged GET
+        bwlimit = maximum MB/s across all workers. None is unlimited
+        manifest = path of manifest. default is in folder
+        returns dict of statistics
+    """
+    s3 = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+    manifest = manifest or os.path.join(folder, MANIFEST)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(manifest))):
+        os.makedirs(os.path.dirname(os.path.abspath(manifest)))
+    done = _load(manifest)
+    lock = threading.Lock()
+    limiter = _Limiter(bwlimit * 2**20) if bwlimit else None
+    progress = _Progress(every)
+
+    # objects to download
+    objects = []
+    skipped = 0
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith("/"):
+                continue
+            # prefix may be a full key
+            relative = obj["Key"][len(prefix):].lstrip("/") \
+                                    or os.path.basename(obj["Key"])
+            path = os.path.join(folder, relative)
+            item = dict(etag=obj["ETag"], size=obj["Size"])
+            if done.get(obj["Key"]) == item and os.path.exists(path) \
+                            and os.path.getsize(path) == obj["Size"]:
+                skipped += 1
+                continue
+            objects.append((obj["Key"], path, item))
+    progress.total = sum(item["size"] for key, path, item in objects)
+
+    # preallocate files and queue parts
+    parts = Queue()
+    remaining = dict()
+    failed = set()
+    for key, path, item in objects:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.truncate(item["size"])
+        offsets = list(range(0, item["size"], partsize))
+        remaining[key] = len(offsets)
+        if not offsets:
+            done[key] = item
+        for offset in offsets:
+            parts.put((key, path, item, offset,
+                       min(partsize, item["size"]-offset)))
+
+    def work():
+        while True:
+            part = parts.get()
+            if part is None:
+                return
+            key, path, item, offset, size = part
+            try:
+                _get(s3, bucket, part, limiter, progress)
+            except Exception as e:
+                print("failed %s at %s: %s" % (key, offset, e),
+                      file=sys.stderr)
+                with lock:
+                    failed.add(key)
+                continue
+            with lock:
+                remaining[key] -= 1
+                if remaining[key] == 0 and key not in failed:
+                    done[key] = item
+                    _save(manifest, done)
+
+    threads = [threading.Thread(target=work) for x in range(workers)]
+    for t in threads:
+        parts.put(None)
+        t.start()
+    for t in threads:
+        t.join()
+    _save(manifest, done)
+
+    stats = progress.stats()
+    stats.update(objects=len(objects)-len(failed), skipped=skipped,
+                 failed=sorted(failed))
+    return stats
+
+######## lower level functions ############################
+
+def _get(s3, bucket, part, limiter, progress, retries=3):
+    """ ranged GET of one part written in place """
+    key, path, item, offset, size = part
+    for attempt in range(retries):
+        try:
+            r = s3.get_object(Bucket=bucket, Key=key, IfMatch=item["etag"],
+                        Range="bytes=%s-%s" % (offset, offset+size-1))
+            body = r["Body"]
+            with open(path, "r+b") as f:
+                f.seek(offset)
+                while True:
+                    buf = body.read(256*2**10)
+                    if not buf:
+                        break
+                    if limiter:
+                        limiter.wait(len(buf))
+                    f.write(buf)
+            # count once part succeeds so retries do not inflate throughput
+            progress.update(size)
+            return
+        except Exception:
+            if attempt == retries-1:
+                raise
+            time.sleep(2**attempt)
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return dict()
+
+def _save(path, done):
+    """ atomic write so an interrupted run leaves a valid manifest """
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(done, f)
+    os.rename(tmp, path)
+
+class _Limiter(object):
+    """ token bucket limiting bytes per second across threads """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self, n):
+        while True:
+            with self.lock:
+                now = time.time()
+                # bucket holds at least n so reads larger than rate complete
+                self.tokens = min(max(self.rate, n),
+                                  self.tokens + (now-self.last)*self.rate)
+                self.last = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                delay = (n-self.tokens) / self.rate
+            time.sleep(delay)
+
+class _Progress(object):
+    """ thread safe throughput reporting """
+    def __init__(self, every):
+        self.every = every
+        self.total = 0
+        self.bytes = 0
+        self.start = self.last = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        with self.lock:
+            self.bytes += n
+            now = time.time()
+            if now - self.last >= self.every:
+                self.last = now
+                print("%.0f/%.0f MB %.1f MB/s" % (self.bytes/2**20,
+                      self.total/2**20, self.bytes/(now-self.start)/2**20))
+                sys.stdout.flush()
+
+    def stats(self):
+        seconds = max(time.time() - self.start, 1e-6)
+        return dict(bytes=self.bytes, seconds=seconds,
+                    mbps=self.bytes/seconds/2**20)
+
+def main():
+    parser = argparse.ArgumentParser(description="stage s3 prefix to folder")
+    parser.add_argument("bucket")
+    parser.add_argument("prefix", nargs="?", default="")
+    parser.add_argument("--folder", default="/v1/data")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--partsize", type=int, default=8*2**20)
+    parser.add_argument("--bwlimit", type=float, default=None,
+                        help="MB/s")
+    parser.add_argument("--endpoint-url", default=None)
+    parser.add_argument("--region", default=None)
+    parser.add_argument("--manifest", default=None)
+    parser.add_argument("--stdin-credentials", action="store_true",
+                        help="read json of AWS_* variables from first line "
+                             "of stdin so keys are not on the command line")
+    args = parser.parse_args()
+    if args.stdin_credentials:
+        os.environ.update(json.loads(sys.stdin.readline()))
+    stats = stage(args.bucket, args.prefix, args.folder, args.workers,
+                  args.partsize, args.bwlimit, args.endpoint_url,
+                  args.region, args.manifest)
+    # last line is parsed by Drive.stage
+    print(json.dumps(stats))
+    if stats["failed"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -6,10 +6,14 @@ NOTE: This is a set of functions not a class
 """
 from .drive import Drive
 from . import apps, aws
+from .host import Host, connect, remote, set_default
 import logging as log
 import os
+from math import ceil
+import re
 import time
 from threading import Thread
+from botocore.exceptions import ClientError
 
 import fabric.api as fab
 from time import sleep
@@ -42,12 +46,13 @@ def configure():
     try:
         # if not already set then use first ip address on account
         if not fab.env.host_string:
-            fab.env.host_string = aws.get_ips()[0]
+            ip = aws.get_ips()[0]
+            set_default(ip)
             try:
-                pyperclip.copy(fab.env.host_string)
+                pyperclip.copy(ip)
             except:
                 log.warning("pyperclip cannot find copy/paste mechanism")
-            log.info("%s put on clipboard and for fabric"%fab.env.host_string)
+            log.info("%s put on clipboard and for fabric"%ip)
     except:
         pass
     fab.env.user = conf["user"]
@@ -73,10 +78,11 @@ def configure():
     if not amis["gpu"]:
         raise Exception(f"{awsregion} region has no amazon/nvidia linux AMI available")
 
-    conf = dict(amis=amis, itypes=conf["itypes"])
+    conf = dict(amis=amis, region=awsregion, regions=conf["regions"],
+                itypes=conf["itypes"], pool=conf.get("pool") or {})
 
 def create(name, itype="free", bootsize=None, drive=None, drivesize=15,
-                           spot=False):
+                           spot=False, region=None, fs="ext4"):
     """ create instance and mount drive
 
         name = name of instance
@@ -84,14 +90,34 @@ def create(name, itype="free", bootsize=None, drive=None, drivesize=15,
         bootsize = size of boot drive
         drive = name of attached, non-boot drive
         spot = spot versus on-demand
+        region = region or list of regions. uses first that holds the latest
+                 snapshot of drive. None for default region or else any
+                 replica region with an itype AMI that holds it. other
+                 regions need the same security group and key.
+        fs = filesystem profile for new drive e.g. ext4, xfs, btrfs
+
+        if the warm pool has a stopped instance of itype then it is started
+        instead of launching a new instance
     """
+    region = select_region(region, drive, itype)
+    ec2 = aws.regional(region)[0]
+    amis = conf["regions"][region]
+    if not amis[itype]:
+        raise Exception(f"{region} region has no {itype} AMI available")
     if drive:
-        drive = Drive(drive)
+        drive = Drive(drive, region)
     
-    if aws.get(name, aws.ec2.instances):
+    if aws.get(name, ec2.instances):
         raise Exception("instance %s already exists"%name)
+
+    # warm pool
+    pool_evict()
+    if not spot and region == conf["region"]:
+        instance = pool_get(itype)
+        if instance:
+            return start_pooled(name, instance, drive, drivesize, fs)
     
-    spec = dict(ImageId=conf["amis"]["free"],
+    spec = dict(ImageId=amis["free"],
                     InstanceType=conf["itypes"]["free"],
                     SecurityGroups=["simon"],
                     KeyName="key",
@@ -100,13 +126,21 @@ def create(name, itype="free", bootsize=None, drive=None, drivesize=15,
 
     # instance type
     spec.update(InstanceType=conf["itypes"][itype],
-                ImageId=conf["amis"][itype])
-
-    # boot drive
-    if bootsize:
+                ImageId=amis[itype])
+
+    # boot drive. hibernation must be configured at launch. only on-demand
+    # instances are pooled.
+    hibernate = None
+    if not spot and conf["pool"].get(itype, {}).get("hibernate", False):
+        hibernate = hibernate_bootsize(itype, region)
+    if bootsize or hibernate:
+        Ebs = dict(VolumeType="gp2",
+                   VolumeSize=max(bootsize or 0, hibernate or 0))
+        if hibernate:
+            Ebs.update(Encrypted=True)
+            spec.update(HibernationOptions=dict(Configured=True))
         bdm = dict(DeviceName="/dev/xvda",
-                   Ebs=dict(VolumeType="gp2",
-                           VolumeSize=bootsize))
+                   Ebs=Ebs)
         spec["BlockDeviceMappings"].append(bdm)
 
     # add drive to instance launch
@@ -123,9 +157,23 @@ def create(name, itype="free", bootsize=None, drive=None, drivesize=15,
 
     # create spot or on-demand instance
     if spot:
-        instance = create_spot(spec, drive)
+        instance = create_spot(spec, drive, region=region)
     else:
-        instance = aws.ec2.create_instances(**spec)[0]
+        try:
+            instance = ec2.create_instances(**spec)[0]
+        except ClientError as e:
+            if not hibernate:
+                raise
+            log.warning(f"launch with hibernation failed so launching "
+                        f"without. {e}")
+            del spec["HibernationOptions"]
+            bdm = spec["BlockDeviceMappings"][0]["Ebs"]
+            del bdm["Encrypted"]
+            if bootsize:
+                bdm.update(VolumeSize=bootsize)
+            else:
+                del bdm["VolumeSize"]
+            instance = ec2.create_instances(**spec)[0]
     aws.set_name(instance, name)
     log.info("waiting for instance running")
     instance.wait_until_running()
@@ -137,47 +185,107 @@ def create(name, itype="free", bootsize=None, drive=None, drivesize=15,
         log.info("awaiting IP address")
         sleep(1)
         instance.load()
-    fab.env.host_string = instance.public_ip_address
+    host = Host(instance.public_ip_address)
+    set_default(host.host_string)
     try:
-        pyperclip.copy(fab.env.host_string)
+        pyperclip.copy(host.host_string)
     except:
         log.warning("pyperclip cannot find copy/paste mechanism")
 
     log.info("instance %s running at %s (clipboard)"
                          %(name, instance.public_ip_address))
-    wait_ssh()
+    wait_ssh(host=host)
 
     # prepare drive
     if drive:
+        drive.host = host
         # set name
         for vol in instance.block_device_mappings:
             if vol["DeviceName"] == "/dev/xvdf":
-                aws.set_name(aws.ec2.Volume(vol["Ebs"]["VolumeId"]),
+                aws.set_name(ec2.Volume(vol["Ebs"]["VolumeId"]),
                                             drive.name)
                 break
         # if new volume then format
         if not latest_snapshot:
-            drive.formatdisk()
+            drive.formatdisk(fs)
         drive.mount()
 
         # install docker
-        apps.install_docker()
-        apps.set_docker_folder("/v1")
+        apps.install_docker(host=host)
+        apps.set_docker_folder("/v1", host=host)
         try:
-            apps.install_nvidia_docker()
+            apps.install_nvidia_docker(host=host)
         except:
             log.warning("failed to install nvidia-docker")
+        apps.restore(host=host)
 
     log.info("instance %s ready at %s (clipboard)"
                                      %(name, instance.public_ip_address))
     return instance
 
-def create_spot(spec, drive=None, spotprice=".25"):
+def hibernate_bootsize(itype, region=None):
+    """ returns boot drive GiB needed to hibernate itype or None if itype
+        cannot hibernate. boot drive holds the AMI and a copy of RAM.
+    """
+    ec2, client = aws.regional(region)
+    itypename = conf["itypes"][itype]
+    try:
+        info = client.describe_instance_types(
+                        InstanceTypes=[itypename])["InstanceTypes"][0]
+    except (ClientError, IndexError) as e:
+        log.warning(f"unable to check hibernation support for {itypename}. "
+                    f"{e}")
+        return None
+    if not info.get("HibernationSupported"):
+        log.warning(f"{itypename} does not support hibernation so pooled "
+                    "instances will be stopped")
+        return None
+    ram = ceil(info["MemoryInfo"]["SizeInMiB"] / 2**10)
+    image = ec2.Image(conf["regions"][region or conf["region"]][itype])
+    root = [bdm["Ebs"]["VolumeSize"] for bdm in image.block_device_mappings
+            if bdm["DeviceName"] == image.root_device_name]
+    return ram + (root[0] if root else 8)
+
+def select_region(region=None, drive=None, itype=None):
+    """ returns region to create instance
+
+        region = region or list of regions. None for default region or any
+                 configured region with an itype AMI if default region does
+                 not hold the latest snapshot
+        drive = name of drive. first region holding its latest snapshot
+    """
+    if region is None:
+        regions = [conf["region"]] + [r for r, amis in conf["regions"].items()
+                                      if r != conf["region"]
+                                      and (amis or {}).get(itype or "free")]
+    elif isinstance(region, list):
+        regions = region
+    else:
+        regions = [region]
+    if not drive:
+        return regions[0]
+    available = Drive(drive).regions()
+    if not available:
+        # new drive
+        return regions[0]
+    for candidate in regions:
+        if candidate in available:
+            if candidate != regions[0]:
+                log.info(f"starting in {candidate} as it holds the latest "
+                         f"{drive} snapshot")
+            return candidate
+        if region is not None:
+            log.warning(f"{candidate} does not have the latest {drive} "
+                        "snapshot")
+    raise Exception(f"latest {drive} snapshot is only in {available}")
+
+def create_spot(spec, drive=None, spotprice=".25", region=None):
     """ returns a spot instance
     """
+    ec2, client = aws.regional(region)
     del spec["MinCount"]
     del spec["MaxCount"]
-    requestId = aws.client.request_spot_instances(
+    requestId = client.request_spot_instances(
                      DryRun=False,
                      SpotPrice=spotprice,
                      LaunchSpecification=spec) \
@@ -189,35 +297,45 @@ def create_spot(spec, drive=None, spotprice=".25"):
     while True:
         # sometimes AWS gives a requestId but waiter says it does not exist
         try:
-            instanceId = aws.client.describe_spot_instance_requests \
+            instanceId = client.describe_spot_instance_requests \
                 (SpotInstanceRequestIds=[requestId]) \
                 ['SpotInstanceRequests'][0] \
                 ['InstanceId']
             if instanceId:
                 break
-        except:
+        except KeyError:
+            # not yet fulfilled
             pass
+        except ClientError as e:
+            if aws.error_code(e) != "InvalidSpotInstanceRequestID.NotFound":
+                raise
         sleep(15)
     log.info("spot request fulfilled %s"%instanceId)
 
     # start thread to poll for AWS termination notice
     if drive:
-        t = Thread(target=spotcheck, name=requestId, args=[requestId, drive.name])
+        t = Thread(target=spotcheck, name=requestId,
+                   args=[requestId, drive.name, region])
         t.start()
 
-    return aws.ec2.Instance(instanceId)
+    return ec2.Instance(instanceId)
 
-def spotcheck(requestId, drive):
+def spotcheck(requestId, drive, region=None):
     """ poll for spot instance termination notice """
-    drive = Drive(drive)
+    drive = Drive(drive, region)
     while True:
-        requests = aws.client.describe_spot_instance_requests \
-                        (SpotInstanceRequestIds=[requestId])
-
         # request already deleted
         try:
+            requests = drive.client.describe_spot_instance_requests \
+                            (SpotInstanceRequestIds=[requestId])
             request = requests['SpotInstanceRequests'][0]
-        except:
+        except (IndexError, ClientError) as e:
+            if isinstance(e, ClientError) and aws.error_code(e) != \
+                                "InvalidSpotInstanceRequestID.NotFound":
+                # throttling is retried by aws so this is a real error
+                log.exception(e)
+                time.sleep(5)
+                continue
             log.warning("request already deleted. you can save volume manually")
             return
 
@@ -225,12 +343,16 @@ def spotcheck(requestId, drive):
         if request["Status"]["Code"] == "marked-for-termination":
             log.warning("spot request marked for termination by amazon. "\
                         "attempting to save volume as snapshot")
+            # explicit host as foreground may be using another instance
+            instance = drive.ec2.Instance(request["InstanceId"])
+            drive.host = Host(instance.public_ip_address)
             drive.disconnect()
             return
 
         # amazon recommend poll every 5 seconds
         time.sleep(5)
 
+@remote
 def optimise_gpu():
     """ disable autoboost 
     https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/accelerated-computing-instances.html#optimize_gpu
@@ -239,57 +361,64 @@ def optimise_gpu():
     fab.sudo("nvidia-smi --auto-boost-default=0")
     fab.sudo("sudo nvidia-smi -ac 2505,875")
 
-def wait_ssh():
+def wait_ssh(host=None):
     """ wait for ssh server """
     apps.setdebug()
+    host = connect(host)
     log.info("waiting for ssh server")
     while True:
-        with fab.quiet():
-            try:
-                r = fab.sudo("ls")
-            except:
-                pass
-            if r.succeeded:
-                break
+        # lock is released between attempts
+        with host:
+            with fab.quiet():
+                try:
+                    if fab.sudo("ls").succeeded:
+                        break
+                except:
+                    pass
         sleep(1)
-    log.info("ssh connected %s"%fab.env.host_string)
+    log.info("ssh connected %s"%host.host_string)
+
+def terminate(instance, save=True, pool=True, host=None):
+    """ terminate instance and save drive as snapshot
 
-def terminate(instance, save=True):
-    """ terminate instance and save drive as snapshot """
+        pool = stop into warm pool instead if configured for itype and
+               pool is not full
+        host = Host. default connects to instance ip address
+    """
     apps.setdebug()
-    
-    # wait for fab connection. fab disconnects if idle for too long.
-    for x in range(2):
-        try:
-            with fab.quiet():
-                fab.run("ls")
-        except ConnectionResetError:
-            pass
 
     if isinstance(instance, str):
-        instance = aws.get(instance)
+        instance = get_instance(instance)
+    # commands below use the host's own connection. this reconnects if idle
+    # and does not wait for fabric commands on other hosts.
+    host = connect(host or instance.public_ip_address)
+
+    region = instance.meta.client.meta.region_name
+    pooled = pool and region == conf["region"] and poolable(instance)
 
     # get the drive
     drive = None
     for bdm in instance.block_device_mappings:
         if bdm["DeviceName"] == "/dev/xvdf":
-            volume = aws.ec2.Volume(bdm["Ebs"]["VolumeId"])
-            drive = Drive(aws.get_name(volume))
+            volume = aws.regional(region)[0].Volume(bdm["Ebs"]["VolumeId"])
+            drive = Drive(aws.get_name(volume), region, host)
             break
 
     if not drive:
-        instance.terminate()
-        aws.set_name(instance, "")
-        log.info("instance terminated")
+        _end(instance, pooled)
         return
     
-    apps.stop_docker()
+    # if docker on xdrive then checkpoint opted in containers
+    folder = apps.get_daemon_config(host=host).get("graph", "")
+    if folder.startswith("/v1"):
+        apps.checkpoint(host=host)
+    apps.stop_docker(host=host)
+    if save:
+        drive.trim()
     drive.unmount()
 
     # terminate instance before snapshot as instances are costly
-    instance.terminate()
-    aws.set_name(instance, "")
-    log.info("instance terminated")
+    _end(instance, pooled)
 
     if save:
         drive.create_snapshot()
@@ -301,27 +430,294 @@ def terminate(instance, save=True):
         log.warning("unable to detach drive. trying to delete anyway")
     drive.delete_volume()
 
+def get_instance(name):
+    """ returns instance by name from any configured region
+        default region first as create can start in a replica region
+    """
+    regions = [conf["region"]] + [r for r in conf["regions"]
+                                  if r != conf["region"]]
+    for region in regions:
+        instance = aws.get(name, aws.regional(region)[0].instances)
+        if instance:
+            return instance
+    raise Exception(f"instance {name} not found in {regions}")
+
+def _end(instance, pooled):
+    """ terminate instance or stop into warm pool """
+    if pooled:
+        pool_put(instance)
+    else:
+        instance.terminate()
+        aws.set_name(instance, "")
+        log.info("instance terminated")
+    pool_evict()
+
+### warm pool ##################################################
+
+POOL = "xdrive-pool"
+POOLED = "xdrive-pooled"
+# hours between idle checks while this process runs
+EVICT_INTERVAL = 1
+_evictor = None
+
+def get_itype(instance):
+    """ returns itype key for instance e.g. gpu """
+    for itype, itypename in conf["itypes"].items():
+        if itypename == instance.instance_type:
+            return itype
+
+def pooled(itype=None):
+    """ returns list of instances in warm pool, most recently pooled first """
+    filters = [dict(Name=f"tag:{POOL}", Values=[itype or "*"]),
+               dict(Name="instance-state-name",
+                    Values=["stopping", "stopped"])]
+    instances = list(aws.ec2.instances.filter(Filters=filters))
+    return sorted(instances, key=lambda i: float(aws.get_tag(i, POOLED) or 0),
+                  reverse=True)
+
+def poolable(instance):
+    """ true if instance can be stopped into the warm pool """
+    itype = get_itype(instance)
+    if itype not in conf["pool"]:
+        return False
+    # spot instances cannot be stopped
+    if instance.instance_lifecycle == "spot":
+        return False
+    return len(pooled(itype)) < conf["pool"][itype].get("size", 1)
+
+def pool_put(instance):
+    """ stop or hibernate instance into warm pool """
+    itype = get_itype(instance)
+    hibernate = conf["pool"][itype].get("hibernate", False)
+    aws.set_name(instance, "")
+    aws.set_tag(instance, POOL, itype)
+    aws.set_tag(instance, POOLED, str(time.time()))
+    _start_evictor()
+    if hibernate:
+        try:
+            instance.stop(Hibernate=True)
+            log.info("instance hibernated into warm pool")
+            return
+        except Exception as e:
+            log.warning(f"hibernate failed so stopping instead. {e}")
+    instance.stop()
+    log.info("instance stopped into warm pool")
+
+def pool_get(itype):
+    """ returns stopped instance of itype from warm pool or None """
+    for instance in pooled(itype):
+        if instance.state["Name"] == "stopped":
+            instance.delete_tags(Tags=[dict(Key=POOL), dict(Key=POOLED)])
+            return instance
+
+def start_pooled(name, instance, drive=None, drivesize=15, fs="ext4"):
+    """ start instance from warm pool and attach drive
+        provisioning is skipped as docker is already installed
+    """
+    apps.setdebug()
+    aws.set_name(instance, name)
+    instance.start()
+    log.info("waiting for pooled instance running")
+    instance.wait_until_running()
+
+    # ip address changes on start
+    while True:
+        instance.load()
+        if instance.public_ip_address:
+            break
+        log.info("awaiting IP address")
+        sleep(1)
+    host = Host(instance.public_ip_address)
+    set_default(host.host_string)
+    try:
+        pyperclip.copy(host.host_string)
+    except:
+        log.warning("pyperclip cannot find copy/paste mechanism")
+    wait_ssh(host=host)
+
+    if drive:
+        drive.host = host
+        new = not aws.get(drive.name, drive.ec2.volumes) \
+                    and drive.latest_snapshot() is None
+        drive.attach(instance, size=drivesize)
+        if new:
+            drive.formatdisk(fs)
+        drive.mount()
+        apps.set_docker_folder("/v1", host=host)
+        apps.start_nvidia_docker_plugin(host=host)
+        apps.restore(host=host)
+
+    log.info("instance %s ready at %s (clipboard)"
+                                     %(name, instance.public_ip_address))
+    return instance
+
+def pool_evict():
+    """ terminate pooled instances that are idle too long or over pool size
+    """
+    counts = dict()
+    for instance in pooled():
+        itype = aws.get_tag(instance, POOL)
+        settings = conf["pool"].get(itype)
+        counts[itype] = counts.get(itype, 0) + 1
+        idle = (time.time() - float(aws.get_tag(instance, POOLED) or 0))/3600
+        if settings is None \
+                or counts[itype] > settings.get("size", 1) \
+                or idle > settings.get("idle", 24):
+            instance.terminate()
+            aws.set_tag(instance, POOL, "")
+            log.info(f"{itype} instance evicted from warm pool "
+                     f"after {idle:.1f} hours")
+
+def _start_evictor():
+    """ evict idle pooled instances in background until pool is empty
+        so cost is bounded without further calls to create or terminate
+    """
+    global _evictor
+    if _evictor and _evictor.is_alive():
+        return
+    def run():
+        while True:
+            sleep(EVICT_INTERVAL * 3600)
+            try:
+                pool_evict()
+                if not pooled():
+                    return
+            except Exception as e:
+                log.exception(e)
+    _evictor = Thread(target=run, daemon=True, name="pool evict")
+    _evictor.start()
+
+def get_pool():
+    """ returns dataframe of warm pool """
+    a = []
+    for i in pooled():
+        idle = (time.time() - float(aws.get_tag(i, POOLED) or 0))/3600
+        a.append([aws.get_tag(i, POOL), i.instance_id, i.instance_type,
+                  i.state["Name"], idle])
+    return pd.DataFrame(a, columns=["itype", "instance_id", "type",
+                                    "state", "idle_hours"])
+
+# one remote call gathers processes and resources for all containers
+TASKS_SCRIPT = """
+echo '### stats'
+docker stats --no-stream --format \
+    '{{.Name}}\t{{.CPUPerc}}\t{{.MemUsage}}\t{{.BlockIO}}' 2>/dev/null
+echo '### gpu'
+nvidia-smi pmon -c 1 -s um 2>/dev/null
+for c in $(docker ps --format '{{.Names}}'); do
+    echo "### top $c"
+    docker top $c -o pid,pcpu,pmem,rss,args 2>/dev/null | tail -n +2
+done
+"""
+
+@remote
 def get_tasks(target="python"):
     """ returns dataframe of tasks on server running inside docker containers
-        where task contains target string
+        where task contains target string. target=None for all tasks.
+
+        cpu, mem are % of host per task. gpu is % utilisation, gpu_mem MB.
+        container_ columns are totals for container. block io in bytes.
     """
     apps.setdebug()
     with fab.quiet():
-        r = fab.run("docker inspect --format='{{.Name}}' "\
-                     "$(docker ps -q)")
-        if r.failed:
-            return None
-    containers = r.splitlines()
-    containers = [container.lstrip("/") for container in containers]
-    cout = []
-    tout = []
-    for container in containers:
-        tasks = fab.run("docker exec %s ps -eo args | grep %s || true"\
-                        %(container, target)).splitlines()
-        for task in tasks:
-            cout.append(container)
-            tout.append(task)
-    out = pd.DataFrame(dict(container=cout, task=tout))
-    return out
+        r = fab.run(TASKS_SCRIPT)
+    if r.failed:
+        return None
+    return _parse_tasks(r, target)
+
+def watch_tasks(interval=5, target="python", count=None, host=None):
+    """ generator of get_tasks dataframes with time column every interval
+        count = number of samples. None for forever
+    """
+    host = connect(host)
+    n = 0
+    while count is None or n < count:
+        start = time.time()
+        df = get_tasks(target, host=host)
+        if df is not None:
+            df.insert(0, "time", pd.Timestamp.now())
+        yield df
+        n += 1
+        sleep(max(0, interval - (time.time() - start)))
+
+def _parse_tasks(output, target=None):
+    """ returns dataframe from output of TASKS_SCRIPT """
+    sections = dict()
+    lines = []
+    for line in output.splitlines():
+        if line.startswith("### "):
+            lines = sections.setdefault(line[4:].strip(), [])
+        elif line.strip():
+            lines.append(line)
+
+    # container totals
+    stats = dict()
+    for line in sections.get("stats", []):
+        if line.count("\t") != 3:
+            continue
+        name, cpu, mem, blockio = line.split("\t")
+        read, write = blockio.split(" / ")
+        stats[name] = dict(container_cpu=_number(cpu),
+                           container_mem=_bytes(mem.split(" / ")[0]),
+                           block_read=_bytes(read),
+                           block_write=_bytes(write))
+
+    # gpu per host pid. column order varies by driver so read from header
+    # e.g. "# gpu pid type sm mem enc dec fb command"
+    gpu = dict()
+    columns = None
+    for line in sections.get("gpu", []):
+        fields = line.lstrip("#").split()
+        if line.startswith("#"):
+            # second header line is units
+            if columns is None and "pid" in fields:
+                columns = fields
+            continue
+        if not columns or len(fields) < len(columns) - 1 \
+                       or not fields[columns.index("pid")].isdigit():
+            continue
+        item = dict(zip(columns, fields))
+        gpu[int(item["pid"])] = dict(gpu=_number(item.get("sm", "-")),
+                                     gpu_mem=_number(item.get("fb", "-")))
+
+    rows = []
+    for section, lines in sections.items():
+        if not section.startswith("top "):
+            continue
+        container = section[4:]
+        for line in lines:
+            fields = line.split(None, 4)
+            # container may exit between docker ps and docker top
+            if len(fields) < 5 or not fields[0].isdigit():
+                continue
+            pid, cpu, mem, rss, task = fields
+            if target and target not in task:
+                continue
+            row = dict(container=container, task=task, pid=int(pid),
+                       cpu=float(cpu), mem=float(mem),
+                       rss_mb=int(rss)/1024)
+            row.update(gpu.get(int(pid), dict(gpu=None, gpu_mem=None)))
+            row.update(stats.get(container, dict()))
+            rows.append(row)
+    return pd.DataFrame(rows, columns=["container", "task", "pid", "cpu",
+                        "mem", "rss_mb", "gpu", "gpu_mem", "container_cpu",
+                        "container_mem", "block_read", "block_write"])
+
+def _number(s):
+    """ returns float from e.g. "12.5%" or None for "-" """
+    try:
+        return float(s.strip().rstrip("%"))
+    except ValueError:
+        return None
+
+UNITS = dict(b=1, kb=1e3, mb=1e6, gb=1e9, tb=1e12,
+             kib=2**10, mib=2**20, gib=2**30, tib=2**40)
+
+def _bytes(s):
+    """ returns bytes from docker stats size e.g. "1.5MiB" """
+    m = re.match(r"([\d.]+)\s*([a-zA-Z]*)", s.strip())
+    if not m:
+        return None
+    return float(m.group(1)) * UNITS.get(m.group(2).lower() or "b", 1)
 
 configure()
\ No newline at end of file
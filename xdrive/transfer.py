@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+parallel transfer of folders between local machine and xdrive volume
+    files are split into chunks sent over several ssh channels at once
+    chunks can be compressed on the fly
+    unchanged files are skipped using md5 checksums
+    interrupted transfers resume from a manifest of completed chunks
+    progress and throughput are logged
+
+NOTE: This is a set of functions not a class
+"""
+import logging as log
+import os
+import gzip
+import json
+import hashlib
+import shlex
+from time import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+import fabric.api as fab
+from . import apps
+from .host import connect
+
+CHUNKSIZE = 16 * 2**20
+BUFSIZE = 2**20
+
+# sshd default MaxSessions is 10 so keep below this
+CHANNELS = 8
+
+MANIFESTS = os.path.join(os.path.expanduser("~"), ".xdrive", "transfers")
+
+def put(local, remote="/v1", channels=CHANNELS, chunksize=CHUNKSIZE,
+                             compress=False, checksum=True, host=None):
+    """ upload local folder to remote folder
+
+        channels = number of parallel ssh channels
+        chunksize = bytes sent per channel request
+        compress = gzip chunks in transit. useful for text; not for images
+        checksum = skip files with same md5 on both sides
+        host = Host. None uses fab.env
+        returns dict of transfer statistics
+    """
+    apps.setdebug()
+    local = os.path.abspath(os.path.expanduser(local))
+    host = connect(host)
+    # chunks are sent on the host's own connection so lock not held for them
+    transport = host.session.get_transport()
+    with host:
+        dst = _remote_files(remote)
+    src = _local_files(local)
+    manifest = _Manifest("put", local, remote, host, chunksize)
+
+    # files to send
+    files = _changed(src, dst, manifest, checksum,
+                     lambda paths: _local_md5(local, paths),
+                     lambda paths: _remote_md5(remote, paths, transport))
+
+    # create folders and empty files of correct size
+    script = []
+    for path in files:
+        target = shlex.quote(f"{remote}/{path}")
+        script.append(f'mkdir -p "$(dirname {target})"')
+        if not manifest.started(path, src[path]):
+            script.append(f"truncate -s {src[path]['size']} {target}")
+    if script:
+        _exec("bash -s", transport, "\n".join(script).encode())
+
+    def send(path, offset, size):
+        with open(os.path.join(local, path), "rb") as f:
+            f.seek(offset)
+            data = f.read(size)
+        target = shlex.quote(f"{remote}/{path}")
+        command = f"dd of={target} bs={BUFSIZE} seek={offset} "\
+                   "oflag=seek_bytes conv=notrunc status=none"
+        if compress:
+            data = gzip.compress(data, compresslevel=1)
+            command = f"gzip -dc | {command}"
+        _exec(command, transport, data)
+        return len(data)
+
+    return _run(files, src, manifest, send, channels, chunksize)
+
+def get(remote, local, channels=CHANNELS, chunksize=CHUNKSIZE,
+                       compress=False, checksum=True, host=None):
+    """ download remote folder to local folder
+
+        channels = number of parallel ssh channels
+        chunksize = bytes received per channel request
+        compress = gzip chunks in transit. useful for text; not for images
+        checksum = skip files with same md5 on both sides
+        host = Host. None uses fab.env
+        returns dict of transfer statistics
+    """
+    apps.setdebug()
+    local = os.path.abspath(os.path.expanduser(local))
+    host = connect(host)
+    # chunks are received on the host's own connection so lock not held
+    transport = host.session.get_transport()
+    with host:
+        src = _remote_files(remote)
+    dst = _local_files(local)
+    manifest = _Manifest("get", local, remote, host, chunksize)
+
+    # files to receive
+    files = _changed(src, dst, manifest, checksum,
+                     lambda paths: _remote_md5(remote, paths, transport),
+                     lambda paths: _local_md5(local, paths))
+
+    # create folders and empty files of correct size
+    for path in files:
+        target = os.path.join(local, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if not manifest.started(path, src[path]):
+            with open(target, "wb") as f:
+                f.truncate(src[path]["size"])
+
+    def receive(path, offset, size):
+        source = shlex.quote(f"{remote}/{path}")
+        command = f"dd if={source} bs={BUFSIZE} skip={offset} count={size} "\
+                   "iflag=skip_bytes,count_bytes status=none"
+        if compress:
+            command = f"{command} | gzip -c -1"
+        data = _exec(command, transport)
+        sent = len(data)
+        if compress:
+            data = gzip.decompress(data)
+        if len(data) != size:
+            raise Exception(f"{path} received {len(data)} bytes at {offset} "
+                            f"but expected {size}")
+        with open(os.path.join(local, path), "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+        return sent
+
+    return _run(files, src, manifest, receive, channels, chunksize)
+
+######## lower level functions ############################
+
+def _run(files, src, manifest, func, channels, chunksize):
+    """ transfer chunks of files in parallel and record progress
+
+        func(path, offset, size) transfers one chunk and returns bytes sent
+    """
+    # chunks still to do
+    jobs = []
+    for path in files:
+        size = src[path]["size"]
+        manifest.start(path, src[path])
+        done = set(manifest.done(path))
+        for index, offset in enumerate(range(0, size, chunksize)):
+            if index not in done:
+                jobs.append((path, index, offset, min(chunksize, size-offset)))
+    progress = _Progress(sum(job[3] for job in jobs))
+
+    def work(job):
+        path, index, offset, size = job
+        sent = func(path, offset, size)
+        manifest.complete(path, index)
+        progress.update(size, sent)
+
+    with ThreadPoolExecutor(max_workers=channels) as pool:
+        # list forces exceptions to be raised. manifest retains progress.
+        list(pool.map(work, jobs))
+    manifest.delete()
+
+    stats = progress.stats()
+    stats.update(files=len(files), skipped=len(src)-len(files))
+    log.info("transferred {files} files ({skipped} unchanged) {bytes} bytes "
+             "in {seconds:.1f} seconds at {mbps:.1f} MB/s".format(**stats))
+    return stats
+
+def _changed(src, dst, manifest, checksum, srcmd5, dstmd5):
+    """ return list of paths that need to be transferred """
+    files = []
+    same_size = []
+    for path, meta in src.items():
+        if path not in dst or dst[path]["size"] != meta["size"]:
+            files.append(path)
+        elif manifest.started(path, meta):
+            # partial transfer has same size as file is preallocated
+            files.append(path)
+        elif checksum:
+            same_size.append(path)
+        else:
+            files.append(path)
+    if same_size:
+        a = srcmd5(same_size)
+        b = dstmd5(same_size)
+        files.extend(path for path in same_size if a[path] != b.get(path))
+    return sorted(files)
+
+def _local_files(folder):
+    """ return dict(relpath=dict(size, mtime)) for local folder """
+    files = dict()
+    for root, dirs, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files[os.path.relpath(path, folder)] = dict(size=stat.st_size,
+                                                 mtime=int(stat.st_mtime))
+    return files
+
+def _remote_files(folder):
+    """ return dict(relpath=dict(size, mtime)) for remote folder """
+    with fab.quiet():
+        r = fab.run(f"find {shlex.quote(folder)} -type f "
+                     "-printf '%s\\t%T@\\t%P\\n'")
+    if r.failed:
+        return dict()
+    files = dict()
+    for line in r.splitlines():
+        size, mtime, path = line.split("\t", 2)
+        files[path] = dict(size=int(size), mtime=int(float(mtime)))
+    return files
+
+def _local_md5(folder, paths):
+    """ return dict(relpath=md5) for local files """
+    out = dict()
+    for path in paths:
+        md5 = hashlib.md5()
+        with open(os.path.join(folder, path), "rb") as f:
+            for buf in iter(lambda: f.read(BUFSIZE), b""):
+                md5.update(buf)
+        out[path] = md5.hexdigest()
+    return out
+
+def _remote_md5(folder, paths, transport):
+    """ return dict(relpath=md5) for remote files in a single call """
+    names = "\0".join(paths).encode()
+    r = _exec(f"cd {shlex.quote(folder)} && xargs -0 md5sum --",
+              transport, names)
+    out = dict()
+    for line in r.decode().splitlines():
+        md5, path = line.split("  ", 1)
+        out[path] = md5
+    return out
+
+def _exec(command, transport, data=b""):
+    """ run command on a new ssh channel and return stdout
+        data is sent to stdin
+    """
+    channel = transport.open_session()
+    try:
+        channel.exec_command(command)
+        if data:
+            channel.sendall(data)
+        channel.shutdown_write()
+        out = []
+        while True:
+            buf = channel.recv(BUFSIZE)
+            if not buf:
+                break
+            out.append(buf)
+        status = channel.recv_exit_status()
+        if status != 0:
+            err = channel.recv_stderr(BUFSIZE).decode(errors="replace")
+            raise Exception(f"{command} failed with status {status}\n{err}")
+        return b"".join(out)
+    finally:
+        channel.close()
+
+class _Manifest():
+    """ record of completed chunks saved locally so transfers can resume
+
+        chunk indices only map to offsets for the same chunksize so a
+        manifest saved with a different chunksize is discarded
+    """
+    def __init__(self, direction, local, remote, host, chunksize):
+        key = f"{direction}|{host.host_string}|{local}|{remote}"
+        key = hashlib.md5(key.encode()).hexdigest()
+        self.path = os.path.join(MANIFESTS, f"{key}.json")
+        self.chunksize = chunksize
+        self.lock = Lock()
+        self.files = dict()
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if saved.get("chunksize") == chunksize:
+            self.files = saved["files"]
+            log.info("resuming previous transfer")
+        else:
+            log.info("previous transfer used different chunksize. restarting")
+
+    def started(self, path, meta):
+        """ true if partial transfer of same file version is recorded """
+        item = self.files.get(path)
+        return item is not None and item["size"] == meta["size"] \
+                                and item["mtime"] == meta["mtime"]
+
+    def start(self, path, meta):
+        if not self.started(path, meta):
+            self.files[path] = dict(size=meta["size"], mtime=meta["mtime"],
+                                    chunks=[])
+
+    def done(self, path):
+        return self.files[path]["chunks"]
+
+    def complete(self, path, index):
+        with self.lock:
+            self.files[path]["chunks"].append(index)
+            os.makedirs(MANIFESTS, exist_ok=True)
+            with open(self.path, "w") as f:
+                json.dump(dict(chunksize=self.chunksize, files=self.files), f)
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class _Progress():
+    """ thread safe progress and throughput logging """
+    def __init__(self, total, every=5):
+        self.total = total
+        self.every = every
+        self.bytes = 0
+        self.sent = 0
+        self.start = self.last = time()
+        self.lock = Lock()
+
+    def update(self, size, sent):
+        with self.lock:
+            self.bytes += size
+            self.sent += sent
+            now = time()
+            if now - self.last >= self.every:
+                self.last = now
+                mbps = self.bytes / (now-self.start) / 2**20
+                log.info(f"{self.bytes/2**20:.0f}/{self.total/2**20:.0f} MB "
+                         f"{mbps:.1f} MB/s")
+
+    def stats(self):
+        seconds = max(time() - self.start, 1e-6)
+        return dict(bytes=self.bytes, sent=self.sent, seconds=seconds,
+                    mbps=self.bytes/seconds/2**20)